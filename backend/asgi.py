@@ -0,0 +1,246 @@
+"""
+Name: ASGI entry point
+Description: Serves the music database's routes from an asyncio server (uvicorn) instead of Flask's
+development server. Audio files and the /api/events stream are handled natively on the event loop, so
+slow or idle clients only cost a coroutine, and every other route runs the Flask app on a thread, at
+most API_WORKERS at a time.
+Set up the database with `python music_database.py init` first, then run with `python asgi.py` (or
+`uvicorn asgi:app`, several workers can share the database). `python music_database.py watch` keeps the
+library in sync with the Music folder.
+"""
+import argparse
+import asyncio
+import mimetypes
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, quote
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import http_date, parse_date, parse_etags, parse_range_header, quote_etag
+
+import music_database
+from music_database import (app as flask_app, audio_paths, bytes_served, queue_owner_for, queues, request_latency,
+                            resolve_audio)
+
+# requests running Flask at once for every route not handled here, and threads for database and file reads
+API_WORKERS = 32
+IO_WORKERS = 8
+# bytes read from disk and sent per chunk of an audio response
+AUDIO_CHUNK_SIZE = 256 * 1024
+
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="asgi-io")
+
+STREAM_PATH = re.compile(r'/api/stream/(\d+)')
+
+
+async def run_db(fn, *args):
+    # runs blocking database (or disk) work off the event loop, SQLite connections come from the pool as usual
+    return await asyncio.get_running_loop().run_in_executor(io_executor, fn, *args)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """
+    asgiref runs every wsgi request on one shared thread. A ThreadSensitiveContext per request gives each
+    one its own thread instead, and the semaphore keeps it to API_WORKERS requests in Flask at a time.
+    """
+
+    def __init__(self, wsgi_application, workers: int = API_WORKERS):
+        super().__init__(wsgi_application)
+        self.workers = asyncio.Semaphore(workers)
+
+    async def __call__(self, scope, receive, send):
+        async with self.workers:
+            async with ThreadSensitiveContext():
+                await super().__call__(scope, receive, send)
+
+
+flask_asgi = ThreadedWsgiToAsgi(flask_app)
+
+
+def header(scope, name: bytes):
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin1")
+    return None
+
+
+async def respond(send, status: int, headers, body: bytes = b""):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(key.encode("latin1"), value.encode("latin1")) for key, value in headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def serve_audio(scope, send, key):
+    """
+    Async version of music_database.send_audio: same validators, range handling and X-Accel-Redirect
+    support, but the file is read in AUDIO_CHUNK_SIZE pieces on io_executor and sent as the client takes
+    it, so a slow client waits on the event loop instead of holding a thread.
+    """
+    cors = [("Access-Control-Allow-Origin", "*")]
+    entry = await run_db(resolve_audio, key)
+    if entry is None:
+        return await respond(send, 404, cors + [("Content-Type", "text/plain")], b"File not found")
+    file_path, etag, mtime = entry
+    content_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+
+    accel_prefix = flask_app.config.get('AUDIO_ACCEL_REDIRECT')
+    if accel_prefix:
+        relative_path = os.path.relpath(file_path, os.path.abspath(music_database.music_directory))
+        location = accel_prefix.rstrip('/') + '/' + quote(relative_path.replace(os.sep, '/'))
+        return await respond(send, 200, cors + [("Content-Type", content_type), ("X-Accel-Redirect", location)])
+
+    try:
+        stat = await run_db(os.stat, file_path)
+    except FileNotFoundError:
+        # removed since it was cached, the watcher will drop the song
+        audio_paths.discard(key)
+        return await respond(send, 404, cors + [("Content-Type", "text/plain")], b"File not found")
+    size = stat.st_size
+    mtime = int(mtime or stat.st_mtime)
+    etag = etag or f"{mtime}-{size}"
+    headers = cors + [
+        ("Accept-Ranges", "bytes"),
+        ("ETag", quote_etag(etag)),
+        ("Last-Modified", http_date(mtime)),
+        ("Cache-Control", f"public, max-age={flask_app.config['AUDIO_MAX_AGE']}"),
+    ]
+
+    if_none_match = header(scope, b"if-none-match")
+    if_modified_since = parse_date(header(scope, b"if-modified-since"))
+    if (parse_etags(if_none_match).contains(etag) if if_none_match
+            else if_modified_since is not None and if_modified_since.timestamp() >= mtime):
+        return await respond(send, 304, headers)
+
+    start, stop, status = 0, size, 200
+    requested = parse_range_header(header(scope, b"range"))
+    if_range = header(scope, b"if-range")
+    if requested is not None and (if_range is None or parse_etags(if_range).contains(etag)):
+        byte_range = requested.range_for_length(size)
+        if byte_range is None:
+            return await respond(send, 416, headers + [("Content-Range", f"bytes */{size}")])
+        start, stop = byte_range
+        status = 206
+        headers.append(("Content-Range", f"bytes {start}-{stop - 1}/{size}"))
+    headers += [("Content-Type", content_type), ("Content-Length", str(stop - start))]
+
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(key.encode("latin1"), value.encode("latin1")) for key, value in headers]})
+    if scope["method"] == "HEAD":
+        return await send({"type": "http.response.body", "body": b""})
+    audio_file = await run_db(open, file_path, "rb")
+    try:
+        await run_db(audio_file.seek, start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = await run_db(audio_file.read, min(AUDIO_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            bytes_served.inc(len(chunk), "audio")
+        if remaining > 0:
+            # the file shrank while it was sent, end the response so the client doesn't hang
+            await send({"type": "http.response.body", "body": b""})
+    finally:
+        await run_db(audio_file.close)
+
+
+async def timed(scope, send, route, key):
+    # serve_audio recorded in the same request latency histogram as the Flask routes
+    start = time.perf_counter()
+    status = []
+
+    async def send_status(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+        await send(message)
+
+    try:
+        await serve_audio(scope, send_status, key)
+    finally:
+        request_latency.observe(time.perf_counter() - start, route, scope["method"], status[0] if status else 500)
+
+
+async def serve_events(scope, receive, send):
+    # /api/events on the event loop, see music_database.queue_events
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream; charset=utf-8"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no"),
+        (b"access-control-allow-origin", b"*"),
+    ]})
+    last_id = header(scope, b"last-event-id")
+    # same queue as music_database.queue_owner picks: the bearer token (or ?token=) and the device id
+    query = parse_qs(scope.get("query_string", b"").decode("latin1"))
+    authorization = (header(scope, b"authorization") or "").split()
+    token = authorization[1] if len(authorization) == 2 and authorization[0] == "Bearer" else query.get("token", [None])[0]
+    device = header(scope, b"x-device-id") or query.get("device", [None])[0]
+    broadcaster = await run_db(lambda: queues.events(queue_owner_for(token, device)))
+    stream = broadcaster.subscribe_async(int(last_id) if last_id and last_id.isdigit() else None, run_db)
+
+    async def forward():
+        async for payload in stream:
+            await send({"type": "http.response.body", "body": payload, "more_body": True})
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(forward()), asyncio.ensure_future(disconnected())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await stream.aclose()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # the same schema check as create_app(), setting up and syncing the library is up to
+            # `python music_database.py init` and `watch`
+            try:
+                await run_db(music_database.create_app)
+            except RuntimeError as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # writes the queue changes that are still waiting for the next flush
+            await run_db(queues.stop)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    # ?bitrate= transcodes, which music_database.send_audio_at_bitrate does on a thread like other routes
+    if scope["type"] == "http" and scope["method"] in ("GET", "HEAD") and b"bitrate=" not in scope["query_string"]:
+        path = scope["path"]
+        if path.startswith("/api/audio/") and len(path) > len("/api/audio/"):
+            return await timed(scope, send, '/api/audio/<path:filename>', ('file', path[len("/api/audio/"):]))
+        match = STREAM_PATH.fullmatch(path)
+        if match:
+            return await timed(scope, send, '/api/stream/<int:song_id>', ('id', int(match.group(1))))
+        if path == "/api/events" and scope["method"] == "GET":
+            return await serve_events(scope, receive, send)
+    await flask_asgi(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import logging
+    import uvicorn
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    parser = argparse.ArgumentParser(description="Serve the music database over ASGI with uvicorn")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    arguments = parser.parse_args()
+    uvicorn.run(app, host=arguments.host, port=arguments.port)
@@ -0,0 +1,342 @@
+"""
+Name: Benchmarks
+Description: Builds a synthetic library in a scratch directory and measures the hot paths of the
+backend: the add_Dir ingest rate and the latency of /api/search, /api/all_songs, /api/random_song,
+/api/queue/move and /api/audio range reads, once request by request and once under concurrent load.
+Results are written as JSON so runs on different commits can be compared.
+Only `--files` real tagged MP3s are generated and ingested; the rest of the `--songs` rows are written
+straight into the database so large libraries (up to 1M songs) can be built in reasonable time.
+Usage: python bench.py --songs 100000 --out results.json
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.client import HTTPConnection
+from urllib.parse import quote, urlsplit
+
+from mutagen.id3 import ID3, TIT2, TPE1, TALB, APIC
+from PIL import Image
+
+# a valid 128kbps 44.1kHz MPEG-1 layer 3 frame of silence, 40 of them make about a second of audio
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+WORDS = ("night", "vision", "river", "light", "fire", "dream", "stone", "heart", "blue", "summer",
+         "ghost", "echo", "gold", "road", "storm", "silver", "city", "ocean", "wild", "shadow",
+         "morning", "electric", "paper", "velvet", "sun", "moon", "glass", "winter", "dance", "home")
+ARTISTS = 500
+ALBUMS = 5000
+
+
+def song_tags(i: int, rng: random.Random):
+    # title, artist and album of synthetic song i
+    title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title() + f" {i}"
+    return title, f"Artist {i % ARTISTS}", f"Album {i % ALBUMS}"
+
+
+def make_library(music_dir: str, files: int, rng: random.Random):
+    # writes `files` tagged MP3s, every album gets its own cover art
+    os.makedirs(music_dir, exist_ok=True)
+    covers = {}
+    for i in range(files):
+        title, artist, album = song_tags(i, rng)
+        path = os.path.join(music_dir, f"track{i:07d}.mp3")
+        with open(path, 'wb') as f:
+            f.write(MP3_FRAME * 40 * rng.randint(5, 30))
+        tags = ID3()
+        tags.add(TIT2(encoding=3, text=title))
+        tags.add(TPE1(encoding=3, text=artist))
+        tags.add(TALB(encoding=3, text=album))
+        if album not in covers:
+            buffer = io.BytesIO()
+            Image.new('RGB', (500, 500), (i * 37 % 256, i * 91 % 256, 128)).save(buffer, 'JPEG')
+            covers[album] = buffer.getvalue()
+        tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='', data=covers[album]))
+        tags.save(path)
+
+
+def fill_database(m, start: int, songs: int, rng: random.Random):
+    # writes songs start..songs-1 as rows through the same batch writer the ingest uses
+    con = m.get_db_connection()
+    cur = con.cursor()
+    batch = []
+    for i in range(start, songs):
+        title, artist, album = song_tags(i, rng)
+        batch.append((title, rng.uniform(90, 400), f"synthetic/track{i:07d}.mp3", album, artist, None,
+                      rng.randint(2_000_000, 9_000_000), 0.0, None))
+        if len(batch) == m.INGEST_BATCH_SIZE * 10:
+            m.write_song_batch(cur, batch)
+            con.commit()
+            batch = []
+    if batch:
+        m.write_song_batch(cur, batch)
+        con.commit()
+    cur.close()
+    con.close()
+
+
+def summarize(latencies):
+    # milliseconds, from a list of seconds
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 3)
+
+    return {
+        "requests": len(latencies),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "min_ms": round(latencies[0] * 1000, 3),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+
+
+class TestClientTarget:
+    # sends requests through the Flask test client, each thread gets its own client
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body, headers=headers or {})
+        data = response.get_data()
+        return response.status_code, data
+
+
+class HTTPTarget:
+    # sends requests to a running server, one keep-alive connection per thread
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = self.local.con = HTTPConnection(self.host, self.port, timeout=30)
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        con.request(method, path, body=payload, headers=headers)
+        response = con.getresponse()
+        return response.status, response.read()
+
+
+class Scenarios:
+    """
+    The requests that get measured. Each scenario returns (method, path, body, headers) for one request,
+    picked at random so repeated runs don't just hit the same cached row.
+    """
+
+    def __init__(self, target, rng: random.Random, audio_files):
+        self.target = target
+        self.rng = rng
+        self.audio_files = audio_files
+        self.queue_ids = []
+        self.lock = threading.Lock()
+
+    def search(self):
+        words = self.rng.sample(WORDS, self.rng.randint(1, 2))
+        query = " ".join(word[:self.rng.randint(2, len(word))] for word in words)
+        return "GET", f"/api/search?q={quote(query)}&limit=50", None, None
+
+    def all_songs_page(self):
+        return "GET", "/api/all_songs?limit=100", None, None
+
+    def random_song(self):
+        return "GET", "/api/random_song", None, None
+
+    def random_song_shuffle(self):
+        return "GET", f"/api/random_song?mode=shuffle&session=bench{self.rng.randint(0, 9)}", None, None
+
+    def queue_move(self):
+        with self.lock:
+            entry_id = self.rng.choice(self.queue_ids)
+        body = {"entry_id": entry_id, "to_position": self.rng.randint(1, len(self.queue_ids))}
+        return "PUT", "/api/queue/move", body, None
+
+    def audio_range(self):
+        name, size = self.rng.choice(self.audio_files)
+        start = self.rng.randint(0, max(0, size - 65536))
+        return "GET", f"/api/audio/{quote(name)}", None, {"Range": f"bytes={start}-{start + 65535}"}
+
+    def fill_queue(self, entries: int):
+        status, data = self.target.request("POST", "/api/queue/bulk", {"ids": list(range(1, entries + 1))})
+        self.queue_ids = [entry["id"] for entry in json.loads(data)["queue"]]
+
+
+def run_sequential(target, scenario, requests: int):
+    latencies, errors = [], 0
+    for _ in range(requests):
+        method, path, body, headers = scenario()
+        start = time.perf_counter()
+        status, _ = target.request(method, path, body, headers)
+        latencies.append(time.perf_counter() - start)
+        errors += status >= 400
+    return {**summarize(latencies), "errors": errors}
+
+
+def run_load(target, scenarios, concurrency: int, duration: float):
+    # `concurrency` threads sending a random mix of the scenarios for `duration` seconds
+    deadline = time.perf_counter() + duration
+    results = {name: [] for name in scenarios}
+    errors = {name: 0 for name in scenarios}
+    names = list(scenarios)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            name = rng.choice(names)
+            method, path, body, headers = scenarios[name]()
+            start = time.perf_counter()
+            status, _ = target.request(method, path, body, headers)
+            results[name].append(time.perf_counter() - start)
+            if status >= 400:
+                errors[name] += 1
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    total = sum(len(latencies) for latencies in results.values())
+    return {
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(total / elapsed, 1),
+        "endpoints": {name: {**summarize(results[name]), "errors": errors[name]} for name in names},
+    }
+
+
+def wait_for_background(m):
+    # lets the cover art resizing and transcodes the app queued finish, no new ones can be queued after this
+    for pool in (m.art_pool, m.transcode_pool, m.prewarm_pool):
+        pool.shutdown(wait=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the music database backend")
+    parser.add_argument("--songs", type=int, default=10000, help="songs in the library (1000 to 1000000)")
+    parser.add_argument("--files", type=int, default=None,
+                        help="real MP3 files generated and ingested with add_Dir (default: min(songs, 2000))")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint in the sequential runs")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads of the load generator")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds the load generator runs")
+    parser.add_argument("--workers", type=int, default=None, help="ingest worker processes")
+    parser.add_argument("--url", help="benchmark a running server (e.g. http://127.0.0.1:5000) instead of the "
+                                      "test client; it has to serve the generated library from --workdir")
+    parser.add_argument("--workdir", help="directory for the library and database (default: a temporary one)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory")
+    parser.add_argument("--seed", type=int, default=581)
+    parser.add_argument("--out", help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    files = min(args.songs, args.files if args.files is not None else 2000)
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="music-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    out = os.path.abspath(args.out) if args.out else None
+    # the module resolves Music, cover_art and profile_images against the working directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    import music_database as m
+    logging.basicConfig(level=logging.WARNING)
+    m.db_path = os.path.join(workdir, "music_library.db")
+    rng = random.Random(args.seed)
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "sqlite": sqlite3.sqlite_version,
+            "songs": args.songs,
+            "files": files,
+            "seed": args.seed,
+            "target": args.url or "test client",
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        }
+    }
+    try:
+        start = time.perf_counter()
+        make_library("Music", files, rng)
+        results["generate_seconds"] = round(time.perf_counter() - start, 3)
+
+        m.migrate()
+        start = time.perf_counter()
+        m.add_Dir("Music", workers=args.workers)
+        elapsed = time.perf_counter() - start
+        results["ingest"] = {"files": files, "seconds": round(elapsed, 3),
+                             "files_per_second": round(files / elapsed, 1) if elapsed else None}
+        # the cover art variants are made in the background, they must not overlap the measurements
+        start = time.perf_counter()
+        wait_for_background(m)
+        results["ingest"]["art_variants_seconds"] = round(time.perf_counter() - start, 3)
+
+        start = time.perf_counter()
+        fill_database(m, files, args.songs, rng)
+        results["fill_seconds"] = round(time.perf_counter() - start, 3)
+
+        target = HTTPTarget(args.url) if args.url else TestClientTarget(m.app)
+        audio_files = [(name, os.path.getsize(os.path.join("Music", name))) for name in os.listdir("Music")]
+        scenarios = Scenarios(target, rng, audio_files)
+        scenarios.fill_queue(200)
+        measured = {
+            "search": scenarios.search,
+            "all_songs_page": scenarios.all_songs_page,
+            "random_song": scenarios.random_song,
+            "random_song_shuffle": scenarios.random_song_shuffle,
+            "queue_move": scenarios.queue_move,
+            "audio_range": scenarios.audio_range,
+        }
+        results["sequential"] = {name: run_sequential(target, scenario, args.requests)
+                                 for name, scenario in measured.items()}
+
+        # one pass over the whole library as a single streamed response
+        start = time.perf_counter()
+        status, data = target.request("GET", "/api/all_songs")
+        results["all_songs_stream"] = {"seconds": round(time.perf_counter() - start, 3), "bytes": len(data),
+                                       "status": status}
+
+        results["load"] = run_load(target, measured, args.concurrency, args.duration)
+    finally:
+        wait_for_background(m)
+        os.chdir("/")
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = json.dumps(results, indent=2)
+    if out:
+        with open(out, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,20 +25,42 @@ of python3 by default
 !!!A LOT OF THE PROGRAM WAS TAKEN FROM THE GITHUB PROJECT LISTED AS A SOURCE, WITH SOME MODIFICATIONS
 MADE TO IT BY AUTHORS AND SOME ERROR CHECKING WITH CHATGPT!!!
 '''
-from flask import Flask, jsonify, request, send_file, abort
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC
+from flask import Flask, jsonify, request, send_file, abort, g, has_app_context, stream_with_context, url_for
 from flask_cors import CORS
 import os
 import sqlite3 as sql
-from tinytag import TinyTag
+from tinytag import tinytag as tinytag_formats
+from PIL import Image
 import random
+import re
+import hashlib
+import base64
+import json
+import mimetypes
+from collections import OrderedDict, deque
+from urllib.parse import quote
+import threading
+import weakref
+import atexit
+import asyncio
+import time
+import ctypes
+import ctypes.util
+import select
+import shutil
+import subprocess
+import struct
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Queue
+from werkzeug.http import quote_etag
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 import jwt
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import partial, wraps
 import io
+import logging
 
 app = Flask(__name__)
 CORS(app)
@@ -50,19 +72,534 @@ app.config['SECRET_KEY'] = 'eecs581'
 app.config['UPLOAD_FOLDER'] = os.path.join(os.getcwd(), 'profile_images')
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
 
+# how long clients may reuse audio responses before revalidating them with the ETag, in seconds
+app.config['AUDIO_MAX_AGE'] = 3600
+# internal nginx location that maps onto the Music folder, when set nginx sends the audio files
+app.config['AUDIO_ACCEL_REDIRECT'] = None
+# seconds between writes of queue changes to the database, at most this much queue history is lost in a
+# crash. 0 writes every change right away
+app.config['QUEUE_FLUSH_INTERVAL'] = 1.0
+# /api/queue/upcoming reads the files of the upcoming songs ahead into the page cache
+app.config['UPCOMING_READAHEAD'] = True
+
+log = logging.getLogger("music_database")
+# messages logged through log_sampled are written at most once per this many seconds per message key
+LOG_SAMPLE_INTERVAL = 10.0
+_log_samples = {}
+_log_samples_lock = threading.Lock()
+
+
+def log_sampled(level, key, message, *args):
+    """
+    Logs a message from a hot path without writing every occurrence: only the first one for `key` in each
+    LOG_SAMPLE_INTERVAL is written, with the number of occurrences that were skipped since the last one.
+    """
+    if not log.isEnabledFor(level):
+        return
+    now = time.monotonic()
+    with _log_samples_lock:
+        last, skipped = _log_samples.get(key, (0.0, 0))
+        if now - last < LOG_SAMPLE_INTERVAL:
+            _log_samples[key] = (last, skipped + 1)
+            return
+        _log_samples[key] = (now, 0)
+    if skipped:
+        message += f" ({skipped} more since the last message)"
+    log.log(level, message, *args)
+
+
 # (Ja) helper function to check allowed ext
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 
+# default and maximum number of results /api/search returns per page
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+
+# largest page /api/all_songs returns and how many rows it streams per chunk without a limit
+ALL_SONGS_MAX_LIMIT = 1000
+ALL_SONGS_STREAM_BATCH = 500
+
+# songs whose audio path AudioPathCache keeps resolved
+AUDIO_PATH_CACHE_SIZE = 4096
+# how many song records the shared metadata cache holds, and how many songs /api/songs resolves per call
+SONG_CACHE_SIZE = 8192
+SONG_BATCH_MAX = 500
+# how long token_required trusts a decoded token and a user's profile before checking again, and how many of each it keeps
+AUTH_CACHE_TTL = 60
+AUTH_CACHE_SIZE = 4096
+# users whose favorite song ids are kept in memory, and how many songs one favorites request may change
+FAVORITES_CACHE_USERS = 4096
+FAVORITES_BULK_MAX = 1000
+# password hashing runs on its own threads (hashlib releases the GIL while hashing) so logins can't
+# starve the request threads; past PASSWORD_HASH_BACKLOG waiting hashes login and register answer 503
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_BACKLOG = 16
+# login and register attempts a client ip gets per AUTH_RATE_PERIOD seconds, and how many ips are tracked
+AUTH_RATE_LIMIT = 10
+AUTH_RATE_PERIOD = 60
+AUTH_RATE_CLIENTS = 10000
+
+# ?bitrate= values (kbps) /api/audio transcodes to, where transcoded files are kept and how many bytes of
+# them, how many songs at the front of the queue get transcoded ahead of time, and how long a request
+# waits for its transcode before it gets the original file instead
+TRANSCODE_BITRATES = (64, 96, 128, 192, 256, 320)
+TRANSCODE_CACHE_DIR = "transcode_cache"
+TRANSCODE_CACHE_BYTES = 2 * 1024 ** 3
+TRANSCODE_PREWARM = 3
+TRANSCODE_TIMEOUT = 60
+# ffmpeg processes running at once, each uses about one core
+transcode_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="transcode")
+# transcodes ahead of time run one at a time on their own thread with a lower CPU priority, so they
+# never hold up a transcode a client is waiting for
+prewarm_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="transcode-prewarm")
+
+# sizes (longest side in px) of the cover art variants made for every piece of art
+ART_SIZES = (64, 256, 1024)
+# content hashed art never changes, so clients can keep it for a year
+ART_MAX_AGE = 31536000
+CONTENT_HASH_NAME = re.compile(r'[0-9a-f]{40}')
+# background threads resizing cover art, Pillow releases the GIL while it resizes
+art_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cover-art")
+# cover art whose variants are queued on art_pool or being made, so each piece of art is queued once
+pending_art = set()
+pending_art_lock = threading.Lock()
+
+# events /api/events keeps for clients that reconnect, and seconds between keep-alive comments
+EVENT_HISTORY = 256
+EVENT_KEEPALIVE = 15
+
+# /api/random_song: how many of the newest songs 'recent' mode favors, how often 'recent' and
+# 'favorites' modes pick from their subset instead of the whole library, and how many sessions keep a shuffle bag
+RANDOM_RECENT_WINDOW = 200
+RANDOM_RECENT_WEIGHT = 0.5
+RANDOM_FAVORITES_WEIGHT = 0.5
+SHUFFLE_BAG_SESSIONS = 1024
+
+# most songs /api/queue/bulk adds with one request
+QUEUE_BULK_MAX = 1000
+# every user has a queue per device (X-Device-Id header), requests without a token use the shared queue
+QUEUE_DEFAULT_DEVICE = "default"
+QUEUE_DEVICE_MAX_LENGTH = 64
+SHARED_QUEUE = (0, QUEUE_DEFAULT_DEVICE)
+# queues kept in memory, the least recently used ones are read back from the database when needed again
+QUEUE_OWNERS_MAX = 10000
+# queue entry ids are taken from sqlite_sequence this many at a time
+QUEUE_ID_BLOCK = 256
+# entries /api/queue/upcoming resolves when ?n= isn't given, and the most it resolves
+UPCOMING_DEFAULT = 3
+UPCOMING_MAX = 50
+
 # (N) this specifies the path for the music_library.db fill that will contain the database
 db_path = os.path.dirname(
     __file__) + '/music_library.db'  # (N) takes the path of the current file plus the name of the .db file
 
 
+'''
+full-text index over song titles, artist names and album names used by /api/search. The rowid of every
+entry is the id of its song and the triggers keep it in sync with the songs, artists and albums tables,
+so every way of adding, changing or removing songs updates the index. prefix='2 3' stores prefix
+indexes for typeahead queries.
+'''
+SEARCH_INDEX_SQL = '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(
+                name, artist, album,
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3'
+            );
+            CREATE TRIGGER IF NOT EXISTS songs_fts_insert AFTER INSERT ON songs BEGIN
+                INSERT INTO songs_fts(rowid, name, artist, album)
+                VALUES (new.id, new.name,
+                        (SELECT name FROM artists WHERE id = new.artist_id),
+                        (SELECT name FROM albums WHERE id = new.album_id));
+            END;
+            CREATE TRIGGER IF NOT EXISTS songs_fts_delete AFTER DELETE ON songs BEGIN
+                DELETE FROM songs_fts WHERE rowid = old.id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS songs_fts_update AFTER UPDATE OF name, artist_id, album_id ON songs BEGIN
+                UPDATE songs_fts
+                SET name = new.name,
+                    artist = (SELECT name FROM artists WHERE id = new.artist_id),
+                    album = (SELECT name FROM albums WHERE id = new.album_id)
+                WHERE rowid = old.id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS artists_fts_update AFTER UPDATE OF name ON artists BEGIN
+                UPDATE songs_fts SET artist = new.name
+                WHERE rowid IN (SELECT id FROM songs WHERE artist_id = new.id);
+            END;
+            CREATE TRIGGER IF NOT EXISTS albums_fts_update AFTER UPDATE OF name ON albums BEGIN
+                UPDATE songs_fts SET album = new.name
+                WHERE rowid IN (SELECT id FROM songs WHERE album_id = new.id);
+            END;
+'''
+
+'''
+fingerprints of music files that have no song row because their tags give the same name, artist and
+album as another song's (UNIQUE (name, artist_id, album_id)). Rescans compare files against these like
+against the songs table, so such a file is only parsed again once it changes.
+'''
+SKIPPED_FILES_SQL = '''
+            CREATE TABLE IF NOT EXISTS skipped_files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL
+            );
+'''
+
+
+'''
+statements behind the endpoints that run on every play, queue change or lookup. The code runs exactly
+these strings and check_query_plans() checks their plans through HOT_QUERIES, so the two can't drift
+apart. The ones with {} take a list of ? placeholders, see placeholders().
+'''
+SONG_SELECT = '''SELECT songs.id, songs.name, artists.name, albums.name, songs.length, songs.path, songs.cover_art
+                 FROM songs
+                 LEFT JOIN artists ON songs.artist_id = artists.id
+                 LEFT JOIN albums ON songs.album_id = albums.id'''
+SONGS_BY_ID_SQL = SONG_SELECT + " WHERE songs.id IN ({})"
+# lowest id last, so it wins for duplicate names when the rows are put into a dictionary in order
+SONGS_BY_NAME_SQL = SONG_SELECT + " WHERE songs.name IN ({}) ORDER BY songs.id DESC"
+SONG_BY_PATH_SQL = "SELECT id, path, size, mtime, hash FROM songs WHERE path = ?"
+ALBUM_SONGS_SQL = "SELECT id, name FROM songs WHERE album_id = ? ORDER BY path, id LIMIT ?"
+ARTIST_SONGS_SQL = '''SELECT songs.id, songs.name FROM songs
+                      LEFT JOIN albums ON songs.album_id = albums.id
+                      WHERE songs.artist_id = ?
+                      ORDER BY albums.name, songs.path, songs.id LIMIT ?'''
+QUEUE_OF_DEVICE_SQL = "SELECT sort_key, id, song_id FROM queue WHERE user_id = ? AND device = ? ORDER BY sort_key, id"
+DELETE_SONG_QUEUE_SQL = "DELETE FROM queue WHERE song_id = ?"
+QUEUE_VERSION_SQL = "SELECT version FROM queue_versions WHERE user_id = ? AND device = ?"
+# gives every queue a new stamp, after removing songs from queues other processes may hold
+TOUCH_ALL_QUEUES_SQL = "UPDATE queue_versions SET version = (SELECT MAX(version) + 1 FROM queue_versions)"
+FAVORITES_OF_USER_SQL = "SELECT song_id FROM favorites WHERE user_id = ?"
+DELETE_SONG_FAVORITES_SQL = "DELETE FROM favorites WHERE song_id = ?"
+USER_BY_NAME_SQL = '''SELECT id, password_hash, name, description, profile_image
+                      FROM users WHERE username = ?'''
+ALL_SONGS_PAGE_SQL = '''SELECT songs.name, artists.name AS artist, albums.name AS album,
+                               songs.length, songs.path, songs.cover_art, songs.id
+                        FROM songs
+                        LEFT JOIN artists ON songs.artist_id = artists.id
+                        LEFT JOIN albums ON songs.album_id = albums.id
+                        WHERE (songs.name, songs.id) > (?, ?)
+                        ORDER BY songs.name ASC, songs.id ASC
+                        LIMIT ?'''
+
+
+def placeholders(count: int):
+    # "?,?,?" for an IN list of count values
+    return ','.join('?' * count)
+
+
+# settings applied to every new connection. WAL lets readers keep going while the ingest or a queue
+# update is writing, NORMAL sync is safe under WAL, and the cache/mmap sizes keep hot pages in memory
+DB_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+)
+# how long a connection waits on a locked database before giving up, in seconds
+DB_BUSY_TIMEOUT = 5.0
+# idle connections kept around per database file, extra ones are really closed when released
+DB_POOL_SIZE = 8
+# prepared statements each connection keeps cached, they stay warm because connections are reused
+DB_STATEMENT_CACHE = 256
+
+
+'''
+Metrics for /metrics in the Prometheus text format. Counters and histograms keep one value per label
+combination; everything is in memory and per process.
+'''
+# upper bounds (seconds) of the latency histogram buckets for requests and for SQLite statements
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            if not self.labels and not self._values:
+                return [(self.name, (), 0)]
+            return [(self.name, label_values, value) for label_values, value in self._values.items()]
+
+    kind = "counter"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels=(), buckets=REQUEST_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {label_values: list(counts) for label_values, counts in self._values.items()}
+        samples = []
+        for label_values, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", label_values + (("le", repr(bound)),), cumulative))
+            samples.append((self.name + "_bucket", label_values + (("le", "+Inf"),), counts[-2]))
+            samples.append((self.name + "_count", label_values, counts[-2]))
+            samples.append((self.name + "_sum", label_values, counts[-1]))
+        return samples
+
+    kind = "histogram"
+
+
+request_latency = Histogram("http_request_duration_seconds", "Time spent handling requests",
+                            ("route", "method", "status"))
+query_latency = Histogram("sqlite_query_duration_seconds", "Time spent executing SQLite statements",
+                          ("statement",), QUERY_BUCKETS)
+bytes_served = Counter("http_response_bytes_total", "Bytes of audio and cover art sent", ("kind",))
+ingest_files_total = Counter("ingest_files_total", "Music files parsed by the ingest")
+ingest_songs_total = Counter("ingest_songs_total", "Songs written by the ingest")
+ingest_seconds_total = Counter("ingest_seconds_total", "Time spent ingesting files")
+transcodes_total = Counter("transcodes_total", "Audio transcodes by how they ended", ("result",))
+queue_writes_total = Counter("queue_writes_total", "Queue entries written to the database by the write-behind journal")
+METRICS = [request_latency, query_latency, bytes_served, ingest_files_total, ingest_songs_total, ingest_seconds_total,
+           transcodes_total, queue_writes_total]
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics(gauges=()):
+    # all METRICS plus (name, help, value) gauges in the Prometheus text exposition format
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, label_values, value in metric.samples():
+            labels = [(label, label_value) for label, label_value in zip(metric.labels, label_values)]
+            labels += [label for label in label_values[len(metric.labels):]]
+            rendered = ",".join(f'{label}="{escape_label(label_value)}"' for label, label_value in labels)
+            lines.append(f"{name}{{{rendered}}} {value}" if rendered else f"{name} {value}")
+    for name, help_text, value in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class TimedCursor(sql.Cursor):
+    # cursor that records how long each statement takes, labelled by its first keyword (SELECT, INSERT, ...)
+    def execute(self, statement, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(statement, parameters)
+        finally:
+            query_latency.observe(time.perf_counter() - start, statement_kind(statement))
+
+    def executemany(self, statement, parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(statement, parameters)
+        finally:
+            query_latency.observe(time.perf_counter() - start, statement_kind(statement))
+
+    def executescript(self, script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            query_latency.observe(time.perf_counter() - start, "SCRIPT")
+
+
+def statement_kind(statement: str):
+    words = statement.split(None, 1)
+    return words[0].upper() if words else ""
+
+
+class PooledConnection(sql.Connection):
+    """
+    sqlite3 connection handed out by ConnectionPool. close() rolls back anything that wasn't committed
+    and gives the connection back to its pool instead of closing it, so callers keep using the normal
+    con.close() pattern.
+    """
+
+    def close(self):
+        self.pool.release(self)
+
+    # statements go through TimedCursor, including the connection's execute shortcuts
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, statement, parameters=()):
+        return self.cursor().execute(statement, parameters)
+
+    def executemany(self, statement, parameters):
+        return self.cursor().executemany(statement, parameters)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+    def really_close(self):
+        super().close()
+
+
+class ConnectionPool:
+    """
+    Pool of configured connections to one database file. Connections are created on demand, have the
+    DB_PRAGMAS applied once and are reused afterwards, which keeps their statement caches warm.
+    """
+
+    def __init__(self, path: str, size: int = DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.pid = os.getpid()
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            con = self._idle.pop() if self._idle else None
+        if con is None:
+            con = sql.connect(self.path, timeout=DB_BUSY_TIMEOUT, factory=PooledConnection,
+                              cached_statements=DB_STATEMENT_CACHE, check_same_thread=False)
+            con.pool = self
+            con.lease = 0
+            for pragma in DB_PRAGMAS:
+                try:
+                    con.execute(pragma)
+                except sql.OperationalError as e:
+                    log.warning("Could not apply '%s'. Error: %s", pragma, e)
+        con.checked_out = True
+        con.lease += 1
+        return con
+
+    def release(self, con):
+        if not con.checked_out:
+            return  # already released, closing twice must not put it in the pool twice
+        con.checked_out = False
+        try:
+            if con.in_transaction:
+                con.rollback()
+        except sql.ProgrammingError:
+            return  # connection was really closed
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(con)
+                return
+        con.really_close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for con in idle:
+            con.really_close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+'''
+library version counter. Every change to songs, artists or albums bumps it, so it changes exactly when
+what /api/all_songs returns can change and can be used as its ETag.
+'''
+LIBRARY_VERSION_SQL = '''
+            CREATE TABLE IF NOT EXISTS library_meta (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                version INTEGER NOT NULL DEFAULT 0
+            );
+            INSERT OR IGNORE INTO library_meta(id, version) VALUES (0, 0);
+            CREATE TRIGGER IF NOT EXISTS songs_version_insert AFTER INSERT ON songs BEGIN
+                UPDATE library_meta SET version = version + 1 WHERE id = 0;
+            END;
+            CREATE TRIGGER IF NOT EXISTS songs_version_delete AFTER DELETE ON songs BEGIN
+                UPDATE library_meta SET version = version + 1 WHERE id = 0;
+            END;
+            CREATE TRIGGER IF NOT EXISTS songs_version_update
+                AFTER UPDATE OF name, album_id, artist_id, length, path, cover_art ON songs BEGIN
+                UPDATE library_meta SET version = version + 1 WHERE id = 0;
+            END;
+            CREATE TRIGGER IF NOT EXISTS artists_version_update AFTER UPDATE OF name ON artists BEGIN
+                UPDATE library_meta SET version = version + 1 WHERE id = 0;
+            END;
+            CREATE TRIGGER IF NOT EXISTS albums_version_update AFTER UPDATE OF name ON albums BEGIN
+                UPDATE library_meta SET version = version + 1 WHERE id = 0;
+            END;
+'''
+
+
 def get_db_connection():
-    return sql.connect(db_path)  # (N) creates the db with that path
+    # (N) creates the db with that path
+    # connections come from a pool for the current db_path, a forked worker starts its own pool
+    # since connections must not be shared across processes
+    pool = _pools.get(db_path)
+    if pool is None or pool.pid != os.getpid():
+        with _pools_lock:
+            pool = _pools.get(db_path)
+            if pool is None or pool.pid != os.getpid():
+                pool = _pools[db_path] = ConnectionPool(db_path)
+    con = pool.acquire()
+    # connections taken while handling a request are remembered so they are released when it ends.
+    # The lease number tells if the connection was closed and already handed to someone else since
+    if has_app_context():
+        g.setdefault('db_connections', []).append((con, con.lease))
+    return con
+
+
+@app.teardown_appcontext
+def release_db_connections(exception=None):
+    # gives back any connection a request handler forgot to close
+    for con, lease in g.pop('db_connections', []):
+        if con.checked_out and con.lease == lease:
+            con.close()
+
+
+# endpoints whose response bodies count towards http_response_bytes_total
+BYTES_SERVED_KINDS = {'serve_audio': 'audio', 'serve_audio_by_id': 'audio', 'serve_cover_art': 'cover_art'}
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    # latency per route pattern (not per url, so /api/song/<song_name> is one series)
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    start = g.get('request_start')
+    if start is not None:
+        request_latency.observe(time.perf_counter() - start, route, request.method, response.status_code)
+    kind = BYTES_SERVED_KINDS.get(request.endpoint)
+    if kind and response.content_length and response.status_code in (200, 206):
+        bytes_served.inc(response.content_length, kind)
+    return response
 
 
 '''
@@ -109,20 +646,24 @@ def create_table():
                 added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 path TEXT,
                 cover_art TEXT,
+                size INTEGER,
+                mtime REAL,
+                hash TEXT,
                 FOREIGN KEY (album_id)  REFERENCES albums(id)  ON DELETE SET DEFAULT,
                 FOREIGN KEY (artist_id) REFERENCES artists(id) ON DELETE SET DEFAULT,
                 UNIQUE (name, artist_id, album_id)
             );
+            CREATE INDEX IF NOT EXISTS songs_path ON songs(path);
             INSERT OR IGNORE INTO artists(id,name) VALUES (0,'UNKNOWN');
             INSERT OR IGNORE INTO albums(id,name) VALUES (0,"UNKNOWN");
             
             CREATE TABLE IF NOT EXISTS queue (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                position INTEGER NOT NULL,
+                sort_key REAL NOT NULL,
                 song_id INTEGER,
-                FOREIGN KEY (song_id) REFERENCES songs(id) ON DELETE CASCADE,
-                UNIQUE(position)
+                FOREIGN KEY (song_id) REFERENCES songs(id) ON DELETE CASCADE
             );
+            CREATE INDEX IF NOT EXISTS queue_sort_key ON queue(sort_key);
 
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -141,96 +682,381 @@ def create_table():
                 FOREIGN KEY (song_id) REFERENCES songs(id) ON DELETE CASCADE,
                 UNIQUE (user_id, song_id)
             );
-            ''')
+            ''' + SEARCH_INDEX_SQL + LIBRARY_VERSION_SQL)
 
     con.commit()
     cur.close()
+    con.close()
 
 
-# (N) Function in charge of adding a single song to the database
-def add_Song(music_file_path: str):
-    con = get_db_connection()
-    cur = con.cursor()
+# (N) this is just grabbing the path of a Music directory in the current repository that will be used as the
+# default for storing music to be added to the database, relative to the current working dir
+music_directory = "Music"
 
-    # (N) check if the actual music file exists and if it does not then return nothing and print out an error
-    if not os.path.exists(music_file_path):
-        print(f"File does not exist: {music_file_path}")
-        return None, None
+# number of parsed songs the writer thread collects before writing them in one transaction
+INGEST_BATCH_SIZE = 500
+# below this many files the process pool costs more to start than it saves, so parse in this process
+INGEST_MIN_PARALLEL = 64
+# how often (in files) the ingest reports its progress
+INGEST_PROGRESS_EVERY = 1000
+
+
+def hash_file(music_file_path: str):
+    # content hash used as part of a song's fingerprint
+    with open(music_file_path, 'rb') as f:
+        return hash_stream(f)
+
+
+def hash_stream(f):
+    # hash_file for a file that is already open, reads it to the end
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+'''
+Readers for the audio formats the library takes, by lowercase file extension. A reader gets an open
+binary file and its size and returns (title, album, artist, duration, embedded image bytes or None),
+reading tags, duration and art in one go. More formats are added with register_reader; everything
+that scans the music folder (ingest, rescans, the watcher) accepts exactly the registered extensions.
+'''
+AUDIO_READERS = {}
 
-    # (N) use tinytag to get information from the music file with the parameters being the path of the music file
-    music_file = TinyTag.get(music_file_path)
 
-    # (N) NOT NEEDED JUST FOR DEBUGGING
-    print(
-        f"Title: {music_file.title}, Album: {music_file.album}, Artist: {music_file.artist}, Length: {music_file.duration}")
+def register_reader(extensions, reader):
+    for extension in extensions:
+        AUDIO_READERS[extension.lower()] = reader
 
-    # (N) taking the name, album, artist, and length from the music file
-    name = music_file.title
-    album = music_file.album
-    artist = music_file.artist
-    length = music_file.duration
+
+def tinytag_reader(parser_class):
+    # reader built on one of tinytag's format parsers
+    def read(audio_file, size):
+        tag = parser_class(audio_file, size)
+        tag.load(tags=True, duration=True, image=True)
+        return tag.title, tag.album, tag.artist, tag.duration, tag.get_image()
+    return read
+
+
+register_reader(("mp3",), tinytag_reader(tinytag_formats.ID3))
+register_reader(("flac",), tinytag_reader(tinytag_formats.Flac))
+register_reader(("m4a", "m4b", "mp4"), tinytag_reader(tinytag_formats.MP4))
+register_reader(("ogg", "oga", "opus"), tinytag_reader(tinytag_formats.Ogg))
+register_reader(("wav",), tinytag_reader(tinytag_formats.Wave))
+register_reader(("aiff", "aif", "aifc"), tinytag_reader(tinytag_formats.Aiff))
+register_reader(("wma",), tinytag_reader(tinytag_formats.Wma))
+
+
+def audio_reader(path: str):
+    # the registered reader for a file name, or None if it isn't an audio format the library takes
+    return AUDIO_READERS.get(os.path.splitext(path)[1][1:].lower())
+
+
+def scan_music_dir(music_dir: str):
+    """
+    Yields an os.DirEntry for every file under music_dir, subdirectories included, that has a registered
+    reader. os.scandir already knows which entries are directories, so nothing but the audio files gets
+    a stat call. Hidden directories are skipped and symlinked directories aren't followed so links can't loop.
+    """
+    pending = [music_dir]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith('.'):
+                            pending.append(entry.path)
+                    elif audio_reader(entry.name) and entry.is_file():
+                        yield entry
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue  # removed while scanning or not readable
+
+
+def read_song_file(music_file_path: str, music_dir: str = music_directory):
+    """
+    Parses one music file and returns the row that will be written for it, or None if it can't be read.
+    Its path is stored relative to music_dir.
+    Runs inside the ingest worker processes, so it must not touch the database. The file is opened once:
+    it is hashed for its fingerprint and then its format's reader gets the tags, duration and embedded
+    cover art.
+    """
+    reader = audio_reader(music_file_path)
+    if reader is None:
+        log_sampled(logging.WARNING, "unknown format", "No reader for %s", music_file_path)
+        return None
+
+    # (N) check if the actual music file exists and if it does not then return nothing and print out an error
+    try:
+        music_file = open(music_file_path, 'rb')
+    except FileNotFoundError:
+        log_sampled(logging.WARNING, "missing file", "File does not exist: %s", music_file_path)
+        return None
+
+    with music_file:
+        # fingerprint of the file so later rescans can tell if it changed
+        stat = os.fstat(music_file.fileno())
+        file_hash = hash_stream(music_file)
+        music_file.seek(0)
+
+        # taking the name, album, artist, length and cover art from the music file
+        try:
+            name, album, artist, length, album_cover = reader(music_file, stat.st_size)
+        except Exception as e:
+            log_sampled(logging.WARNING, "unreadable tags", "Could not read tags from %s. Error: %s",
+                        music_file_path, e)
+            return None
 
     # (N) changing the double quotes to single quotes on album names to avoid issues when doing SQL queries in the future
     if album:
         album = album.replace('"', "'")
 
-    # (N) if there is an artist insert the artist name from the music file into the database
-    # (N) will ignore it if the artist is already in the database
-    if artist:
-        cur.execute('INSERT OR IGNORE INTO artists(name) VALUES (?);', (artist,))
-
-    # (N) if there is both an artist and an album name, add that into the albums directory
-    # (N) will ignore if there is already an album with the same name and artists
-    if album and artist:
-        cur.execute('''INSERT OR IGNORE INTO albums(name, artist_id) 
-                       SELECT ?, (SELECT id FROM artists WHERE name = ?);''', (album, artist))
-
     # (N) this if statement checks to see if the name is a value like None or one that can't be used
     if not name:
         # (N) if that is the case then it will try to extract the name from the path instead
         name = os.path.basename(music_file_path).split(".")[0]
-        
-    music_directory = os.path.abspath("Music")
-    relative_path = os.path.relpath(music_file_path, start=music_directory)
-    
+
+    relative_path = os.path.relpath(music_file_path, start=os.path.abspath(music_dir))
+
+    cover_art_path = None
+    if album_cover:
+        cover_art_path = save_cover_art(album_cover)
+
+    return name, length, relative_path, album, artist, cover_art_path, stat.st_size, stat.st_mtime, file_hash
+
+
+def save_cover_art(image_data: bytes):
+    """
+    Stores embedded cover art under the hash of its bytes, so albums (or songs) sharing the same art
+    share one file, and returns its path. The resized variants are made later by make_art_variants.
+    """
+    extension = "png" if image_data.startswith(b'\x89PNG') else "jpg"
+    cover_art_dir = os.path.abspath("cover_art")
+    cover_art_path = os.path.join(cover_art_dir, f"{hashlib.sha1(image_data).hexdigest()}.{extension}")
+
+    # Save cover art only if it doesn't already exist
+    if not os.path.exists(cover_art_path):
+        os.makedirs(cover_art_dir, exist_ok=True)
+        write_replacing(cover_art_path, lambda img: img.write(image_data))
+    return cover_art_path
+
+
+def write_replacing(path: str, write):
+    # writes a file through a uniquely named temp file next to it, so concurrent writers never share one
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
     try:
-        audio = MP3(music_file_path, ID3=ID3)
-        if audio.tags and 'APIC:' in audio.tags:
-            album_cover = audio.tags['APIC:'].data
-            cover_art_dir = os.path.abspath("cover_art")
-            cover_art_path = os.path.join(cover_art_dir, f"{album}.jpg")
-
-            # Save cover art only if it doesn't already exist
-            if not os.path.exists(cover_art_path):
-                os.makedirs("cover_art", exist_ok=True)
-                with open(cover_art_path, 'wb') as img:
-                    img.write(album_cover)
-    except Exception as e:
-        print(f"No cover art found in {music_file_path}. Error: {e}")
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def art_variant_path(cover_art_path: str, size: int):
+    # <hash>.jpg -> <hash>_<size>.jpg, every variant is a JPEG
+    return f"{os.path.splitext(cover_art_path)[0]}_{size}.jpg"
+
+
+def make_art_variants(cover_art_path: str):
+    # writes the ART_SIZES variants of a piece of cover art that don't exist yet
+    try:
+        with Image.open(cover_art_path) as original:
+            original.load()
+            for size in ART_SIZES:
+                variant_path = art_variant_path(cover_art_path, size)
+                if os.path.exists(variant_path):
+                    continue
+                variant = original.convert("RGB")
+                variant.thumbnail((size, size), Image.LANCZOS)
+                write_replacing(variant_path, lambda file: variant.save(file, "JPEG", quality=85, optimize=True))
+    except (OSError, ValueError) as e:
+        log.warning("Could not make cover art variants for %s. Error: %s", cover_art_path, e)
+    finally:
+        with pending_art_lock:
+            pending_art.discard(cover_art_path)
+
+
+def queue_art_variants(cover_art_paths):
+    # hands cover art that is missing variants to the background art pool, unless it is already queued
+    for cover_art_path in set(cover_art_paths):
+        if cover_art_path and not os.path.exists(art_variant_path(cover_art_path, ART_SIZES[-1])):
+            with pending_art_lock:
+                if cover_art_path in pending_art:
+                    continue
+                pending_art.add(cover_art_path)
+            art_pool.submit(make_art_variants, cover_art_path)
+
+
+def write_song_batch(cur, records):
+    """
+    Writes a batch of rows from read_song_file using one executemany per table. The caller owns the
+    transaction, so a whole batch lands in a single commit. Files that are already in the database
+    (matched by path) have their row updated in place so the song keeps its id. Returns how many of
+    the rows were written, files skipped as duplicates of another song don't count.
+    """
+    # insert the artists, ignoring the ones already in the database
+    artists = {(record[4],) for record in records if record[4]}
+    cur.executemany('INSERT OR IGNORE INTO artists(name) VALUES (?);', artists)
+
+    # add the albums that have both an album name and an artist, ignoring existing album/artist pairs
+    albums = {(record[3], record[4]) for record in records if record[3] and record[4]}
+    cur.executemany('''INSERT OR IGNORE INTO albums(name, artist_id) 
+                       SELECT ?, (SELECT id FROM artists WHERE name = ?);''', albums)
 
     # (N) it will always add the song name into the database, with the relevant data for name, length, path, album_id, artist_id, and cover art for the song
-    cur.execute('''INSERT OR IGNORE INTO songs(name, length, path, album_id, artist_id, cover_art)
-                   SELECT ?, ?, ?,
-                          (SELECT COALESCE((SELECT id FROM albums WHERE name = ?), 0)), 
-                          (SELECT COALESCE((SELECT id FROM artists WHERE name = ?), 0)),
-                          ?;
-    ''', (name, length, relative_path, album, artist, cover_art_path))
+    # files that changed since the last scan get their existing row updated
+    cur.executemany('''UPDATE OR IGNORE songs
+                   SET name = :name, length = :length,
+                       album_id = (SELECT COALESCE((SELECT id FROM albums WHERE name = :album), 0)),
+                       artist_id = (SELECT COALESCE((SELECT id FROM artists WHERE name = :artist), 0)),
+                       cover_art = :cover_art, size = :size, mtime = :mtime, hash = :hash
+                   WHERE path = :path;
+    ''', (_song_params(record) for record in records))
+    cur.executemany('''INSERT OR IGNORE INTO songs(name, length, path, album_id, artist_id, cover_art, size, mtime, hash)
+                   SELECT :name, :length, :path,
+                          (SELECT COALESCE((SELECT id FROM albums WHERE name = :album), 0)), 
+                          (SELECT COALESCE((SELECT id FROM artists WHERE name = :artist), 0)),
+                          :cover_art, :size, :mtime, :hash
+                   WHERE NOT EXISTS (SELECT 1 FROM songs WHERE path = :path);
+    ''', (_song_params(record) for record in records))
+
+    # files whose row wasn't written because their tags collide with another song get their fingerprint
+    # kept in skipped_files instead, so rescans don't parse them again and again
+    written = set()
+    for start in range(0, len(records), SONG_BATCH_MAX):
+        chunk = [record[2] for record in records[start:start + SONG_BATCH_MAX]]
+        cur.execute(f"SELECT path, size, mtime FROM songs WHERE path IN ({','.join('?' * len(chunk))})", chunk)
+        written.update(cur.fetchall())
+    skipped = [record for record in records if (record[2], record[6], record[7]) not in written]
+    cur.executemany("DELETE FROM skipped_files WHERE path = ?",
+                    [(record[2],) for record in records if (record[2], record[6], record[7]) in written])
+    cur.executemany("INSERT OR REPLACE INTO skipped_files(path, size, mtime) VALUES (?, ?, ?)",
+                    [(record[2], record[6], record[7]) for record in skipped])
+    for record in skipped:
+        log_sampled(logging.WARNING, "duplicate song", "%s was not added, another song already has the title "
+                    "'%s' with the same artist and album.", record[2], record[0])
+    return len(records) - len(skipped)
+
+
+def _song_params(record):
+    # named parameters for the song statements in write_song_batch
+    name, length, path, album, artist, cover_art, size, mtime, file_hash = record
+    return {'name': name, 'length': length, 'path': path, 'album': album, 'artist': artist,
+            'cover_art': cover_art, 'size': size, 'mtime': mtime, 'hash': file_hash}
+
+
+# (N) Function in charge of adding a single song to the database
+def add_Song(music_file_path: str):
+    record = read_song_file(music_file_path)
+    if record is None:
+        return None, None
 
+    con = get_db_connection()
+    cur = con.cursor()
+    write_song_batch(cur, [record])
     con.commit()  # (N) committing changes
     cur.close()
+    con.close()
+    audio_paths.clear()
+    queue_art_variants([record[5]])
 
+    name, length = record[0], record[1]
     return name, length
 
 
-# (N) this is just grabbing the path of a Music directory in the current repository that will be used as the
-# default for storing music to be added to the database. cwd is the function to get the current working dir
-music_directory = "Music"
-print(music_directory)
-full_path = os.path.abspath(music_directory)
-print(full_path)
+def _ingest_writer(records, stats):
+    """
+    Writer thread of the ingest pipeline. Takes parsed rows off the records queue and writes them in
+    batches of INGEST_BATCH_SIZE, one transaction per batch, until it receives None. If a batch fails
+    the error goes into stats['error'] and the rest of the queue is drained without writing, so the
+    producer never blocks on a full queue.
+    """
+    con = get_db_connection()
+    cur = con.cursor()
+    batch = []
+    while True:
+        record = records.get()
+        if record is not None and 'error' not in stats:
+            batch.append(record)
+        if batch and (record is None or len(batch) >= INGEST_BATCH_SIZE):
+            try:
+                written = write_song_batch(cur, batch)
+                con.commit()
+                stats['written'] += written
+            except Exception as e:
+                con.rollback()
+                stats['error'] = e
+            batch = []
+        if record is None:
+            break
+    cur.close()
+    con.close()
+
+
+def ingest_files(paths, workers=None, music_dir: str = music_directory):
+    """
+    Adds many music files under music_dir to the database. The files are parsed in a pool of worker processes and the
+    parsed rows are streamed to a single writer thread that inserts them in large batches, so SQLite only
+    ever sees one writer. Logs progress and throughput while it runs and returns the names of the
+    songs that were read.
+    """
+    paths = list(paths)
+    total = len(paths)
+    if not total:
+        return []
+
+    stats = {'written': 0}
+    records = Queue(maxsize=INGEST_BATCH_SIZE * 4)
+    writer = threading.Thread(target=_ingest_writer, args=(records, stats), daemon=True)
+    writer.start()
+
+    start = time.perf_counter()
+    names = []
+    cover_art_paths = set()
+    pool = None
+    read = partial(read_song_file, music_dir=music_dir)
+    try:
+        if total < INGEST_MIN_PARALLEL or workers == 1:
+            parsed = map(read, paths)
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers)
+            chunksize = max(1, min(64, total // ((workers or os.cpu_count() or 1) * 4)))
+            parsed = pool.map(read, paths, chunksize=chunksize)
+
+        for done, record in enumerate(parsed, start=1):
+            if 'error' in stats:
+                break  # the writer failed, nothing more would be written
+            if record is not None:
+                names.append(record[0])
+                records.put(record)
+                cover_art_paths.add(record[5])
+            if done % INGEST_PROGRESS_EVERY == 0:
+                elapsed = time.perf_counter() - start
+                log.info("Parsed %d/%d files (%.0f files/s)", done, total, done / elapsed)
+    finally:
+        records.put(None)
+        writer.join()
+        if pool is not None:
+            pool.shutdown()
+        audio_paths.clear()
+        queue_art_variants(cover_art_paths)
+
+    if 'error' in stats:
+        log.error("Ingest stopped after writing %d songs. Error: %s", stats['written'], stats['error'])
+        raise stats['error']
+
+    elapsed = time.perf_counter() - start
+    ingest_files_total.inc(total)
+    ingest_songs_total.inc(stats['written'])
+    ingest_seconds_total.inc(elapsed)
+    log.info("Ingested %d songs from %d files in %.2fs (%.0f files/s)",
+             stats['written'], total, elapsed, total / elapsed if elapsed else total)
+    return names
 
-current_dir = os.getcwd()
-print(current_dir)
 
 '''
 (N) function in charge of adding music_files from an entire directory into the database. 
@@ -238,72 +1064,931 @@ Referenced from the github repository in references
 '''
 
 
-def add_Dir(music_dir: str = music_directory):
+def add_Dir(music_dir: str = music_directory, workers=None):
     # (N) making sure the path to the directory with music stored is a valid path
     if not os.path.isdir(music_dir):
         raise ValueError("Not a valid directory")
 
-    # (N) initializing a counter for the number of files that will be added
-    n = 0
-    names = []
-    for file_ in os.listdir(
-            music_dir):  # (N) iterating through all of the files that are contained in the music directory that we are looking at
-        if file_.split('.')[-1] in [
-            "mp3"]:  # (N) right now we are only looking at .mp3 files so we are only looking for files with that extension
-            n += 1
-            print(f'Adding song from: {music_dir}/{file_}')
-            name, _ = add_Song(
-                music_dir + '/' + file_)  # (N) using the add_Song function to add the song using the path of the music file
-            names.append(
-                name)  # (N) adding the name of the song that was added to a list of names to keep track of songs added
+    # (N) iterating through all of the files that are contained in the music directory that we are looking at
+    # and its subdirectories, keeping the ones in a format that has a reader
+    paths = [entry.path for entry in scan_music_dir(music_dir)]
 
-    return n, names  # (N) return the number of songs and the names of the songs that were addes
+    # parsing and adding all of the songs at once, keeping the names of the songs that were added
+    names = ingest_files(paths, workers=workers, music_dir=music_dir)
+
+    return len(paths), names  # (N) return the number of songs and the names of the songs that were addes
+
+
+def rescan_library(music_dir: str = music_directory, workers=None):
+    """
+    Brings the database in line with the music directory without re-importing everything. Files whose
+    size and mtime match their stored fingerprint are skipped, files whose mtime changed but whose
+    content hash didn't only get their fingerprint refreshed, new or changed files are parsed through
+    ingest_files and rows for files that no longer exist are deleted.
+    Returns a dict with the number of added/updated, unchanged and removed songs.
+    """
+    if not os.path.isdir(music_dir):
+        raise ValueError("Not a valid directory")
+
+    music_dir_path = os.path.abspath(music_dir)
+    on_disk = {}
+    for entry in scan_music_dir(music_dir):
+        on_disk[os.path.relpath(entry.path, start=music_dir_path)] = (entry.path, entry.stat())
+
+    con = get_db_connection()
+    cur = con.cursor()
+    cur.execute("SELECT id, path, size, mtime, hash FROM songs")
+    known = {row[1]: row for row in cur.fetchall()}
+    cur.execute("SELECT path, size, mtime FROM skipped_files")
+    skipped = {row[0]: row for row in cur.fetchall()}
+    cur.close()
+    con.close()
+
+    result = _sync_songs(on_disk, known, skipped, workers=workers, music_dir=music_dir)
+    log.info("Rescan of %s: %d new or changed, %d unchanged, %d removed",
+             music_dir, result['parsed'], result['unchanged'], result['removed'])
+    return result
+
+
+def sync_files(paths, workers=None, music_dir: str = music_directory):
+    """
+    Same as rescan_library but only for the given files, used by the library watcher and uploads.
+    Paths that no longer exist have their songs removed. Returns the names of the songs that were parsed.
+    """
+    music_dir_path = os.path.abspath(music_dir)
+    on_disk = {}
+    relative_paths = set()
+    for path in paths:
+        relative_path = os.path.relpath(path, start=music_dir_path)
+        relative_paths.add(relative_path)
+        if audio_reader(path) and os.path.isfile(path):
+            on_disk[relative_path] = (path, os.stat(path))
+
+    con = get_db_connection()
+    cur = con.cursor()
+    known = {}
+    skipped = {}
+    for relative_path in relative_paths:
+        cur.execute(SONG_BY_PATH_SQL, (relative_path,))
+        for row in cur.fetchall():
+            known[row[1]] = row
+        cur.execute("SELECT path, size, mtime FROM skipped_files WHERE path = ?", (relative_path,))
+        for row in cur.fetchall():
+            skipped[row[0]] = row
+    cur.close()
+    con.close()
+
+    return _sync_songs(on_disk, known, skipped, workers=workers, music_dir=music_dir)["names"]
+
+
+def _sync_songs(on_disk, known, skipped, workers=None, music_dir: str = music_directory):
+    """
+    Shared part of rescan_library and sync_files. on_disk maps paths relative to music_dir to (path,
+    os.stat result) for the files that exist, known maps them to their (id, path, size, mtime, hash) rows
+    and skipped to their (path, size, mtime) rows in skipped_files. Anything in known or skipped that
+    isn't on disk anymore is deleted. Once a song is removed every skipped file is parsed again, since it may
+    have been the song they collided with.
+    """
+    removed = [(row[0],) for relative_path, row in known.items() if relative_path not in on_disk]
+    gone = [(relative_path,) for relative_path in skipped if removed or relative_path not in on_disk]
+    if removed:
+        skipped = {}
+    to_parse = []
+    touched = []
+    unchanged = 0
+    for relative_path, (path, stat) in on_disk.items():
+        row = known.get(relative_path)
+        fingerprint = skipped.get(relative_path)
+        if fingerprint is not None and fingerprint[1] == stat.st_size and fingerprint[2] == stat.st_mtime:
+            unchanged += 1
+        elif row is None:
+            to_parse.append(path)
+        elif row[2] == stat.st_size and row[3] == stat.st_mtime:
+            unchanged += 1
+        elif row[2] == stat.st_size and row[4] is not None and row[4] == hash_file(path):
+            # file was touched or copied over with the same content, no need to parse it again
+            touched.append((stat.st_mtime, row[0]))
+            unchanged += 1
+        else:
+            to_parse.append(path)
+
+    if touched or removed or gone:
+        con = get_db_connection()
+        cur = con.cursor()
+        cur.executemany("DELETE FROM skipped_files WHERE path = ?", gone)
+        cur.executemany("UPDATE songs SET mtime = ? WHERE id = ?", touched)
+        cur.executemany(DELETE_SONG_QUEUE_SQL, removed)
+        cur.executemany(DELETE_SONG_FAVORITES_SQL, removed)
+        cur.executemany("DELETE FROM songs WHERE id = ?", removed)
+        if removed:
+            cur.execute(TOUCH_ALL_QUEUES_SQL)
+        con.commit()
+        cur.close()
+        con.close()
+        audio_paths.clear()
+        song_ids.remove(song_id for song_id, in removed)
+        if removed:
+            favorite_sets.clear()
+        for owner in queues.drop_songs(song_id for song_id, in removed):
+            publish_queue_event('reset', owner)
+
+    names = ingest_files(to_parse, workers=workers, music_dir=music_dir)
+    return {"parsed": len(to_parse), "unchanged": unchanged, "removed": len(removed), "names": names}
+
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class LibraryWatcher:
+    """
+    Background thread that keeps the database in sync with the music directory and its subdirectories.
+    Uses inotify (one watch per directory) when the platform has it and falls back to polling the tree
+    otherwise. Changed paths are collected until no new events have arrived for `debounce` seconds and
+    are then handed to sync_files in one go, so a file being copied in (or a batch of files) is only
+    ingested once. When a directory is added, moved or removed the whole library is rescanned instead,
+    which only parses the files whose fingerprints changed.
+    """
+
+    def __init__(self, music_dir: str = music_directory, debounce: float = 0.5, poll_interval: float = 2.0):
+        self.music_dir = music_dir
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._pending = set()
+        self._rescan = False
+        self._last_event = 0.0
+        self._libc = None
+        self._dirs = {}  # inotify watch descriptor -> directory
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="library-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        fd = self._inotify_open()
+        if fd is None:
+            log.info("inotify not available, polling %s every %ss", self.music_dir, self.poll_interval)
+            self._poll()
+        else:
+            try:
+                self._watch(fd)
+            finally:
+                os.close(fd)
+
+    def _inotify_open(self):
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = self._libc.inotify_init1(IN_NONBLOCK)
+            if fd < 0:
+                return None
+            if not self._watch_tree(fd, self.music_dir):
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError, TypeError):
+            return None
+
+    def _watch_tree(self, fd, directory):
+        # adds a watch for directory and every directory below it, False if directory itself can't be watched
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            wd = self._libc.inotify_add_watch(fd, os.path.abspath(current).encode(), WATCH_MASK)
+            if wd < 0:
+                if current == directory:
+                    return False
+                continue
+            self._dirs[wd] = current
+            try:
+                with os.scandir(current) as entries:
+                    pending.extend(entry.path for entry in entries
+                                   if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.'))
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                pass
+        return True
+
+    def _watch(self, fd):
+        while not self._stop.is_set():
+            timeout = self.debounce if self._pending or self._rescan else 1.0
+            readable, _, _ = select.select([fd], [], [], timeout)
+            if readable:
+                try:
+                    data = os.read(fd, 64 * 1024)
+                except BlockingIOError:
+                    data = b''
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+                    offset += _INOTIFY_EVENT.size
+                    name = data[offset:offset + length].rstrip(b'\0').decode(errors='surrogateescape')
+                    offset += length
+                    if mask & IN_IGNORED:
+                        self._dirs.pop(wd, None)  # its directory is gone
+                    elif wd in self._dirs:
+                        path = os.path.join(self._dirs[wd], name)
+                        if mask & IN_ISDIR:
+                            if mask & (IN_CREATE | IN_MOVED_TO) and not name.startswith('.'):
+                                self._watch_tree(fd, path)
+                            self._rescan = True
+                            self._last_event = time.monotonic()
+                        elif mask & (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+                            self._add(path)
+            self._flush_if_quiet()
+
+    def _poll(self):
+        snapshot = self._snapshot()
+        while not self._stop.wait(self.debounce if self._pending or self._rescan else self.poll_interval):
+            current = self._snapshot()
+            for path in current.keys() | snapshot.keys():
+                if current.get(path) != snapshot.get(path):
+                    self._add(path)
+            snapshot = current
+            self._flush_if_quiet()
+
+    def _snapshot(self):
+        snapshot = {}
+        for entry in scan_music_dir(self.music_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            snapshot[entry.path] = (stat.st_size, stat.st_mtime)
+        return snapshot
+
+    def _add(self, path):
+        if audio_reader(path):
+            self._pending.add(path)
+            self._last_event = time.monotonic()
+
+    def _flush_if_quiet(self):
+        if (self._pending or self._rescan) and time.monotonic() - self._last_event >= self.debounce:
+            paths, self._pending = self._pending, set()
+            rescan, self._rescan = self._rescan, False
+            try:
+                if rescan:
+                    rescan_library(self.music_dir)
+                else:
+                    sync_files(paths, music_dir=self.music_dir)
+            except Exception as e:
+                log.exception("Library watcher failed to sync %d files. Error: %s", len(paths), e)
 
 
 def deleteSong(song_name: str):  # (N) Function that deletes a song from the database
     con = get_db_connection()
     cur = con.cursor()
-    cur.executescript(
-        f'DELETE FROM songs WHERE name = "{song_name}";')  # (N) simple SQL query where it matches the song name and deletes entries based on that
+    cur.execute("SELECT id FROM songs WHERE name = ?", (song_name,))
+    removed = [row[0] for row in cur.fetchall()]
+    cur.execute("DELETE FROM queue WHERE song_id IN (SELECT id FROM songs WHERE name = ?)", (song_name,))
+    cur.execute(TOUCH_ALL_QUEUES_SQL)
+    cur.execute("DELETE FROM favorites WHERE song_id IN (SELECT id FROM songs WHERE name = ?)", (song_name,))
+    cur.execute(
+        'DELETE FROM songs WHERE name = ?;', (song_name,))  # (N) simple SQL query where it matches the song name and deletes entries based on that
     con.commit()
     cur.close()
+    con.close()
+    audio_paths.clear()
+    song_ids.remove(removed)
+    favorite_sets.clear()
+    for owner in queues.drop_songs(removed):
+        publish_queue_event('reset', owner)
 
 
 def clear_table():  # (N) clears the database by dropping all the tables in the database
+    # the library tables are dropped along with schema_version and built again by migrate(), so add_Dir()
+    # afterwards re-imports everything. Users are kept, their favorites are not since the songs are gone
     con = get_db_connection()
     cur = con.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'library_meta'")
+    version = get_library_version(cur) if cur.fetchone() else 0
     cur.executescript('''DROP TABLE IF EXISTS artists;
                         DROP TABLE IF EXISTS songs;
+                        DROP TABLE IF EXISTS songs_fts;
+                        DROP TABLE IF EXISTS library_meta;
                         DROP TABLE IF EXISTS albums;
-                        DROP TABLE IF EXISTS queue''')
+                        DROP TABLE IF EXISTS skipped_files;
+                        DROP TABLE IF EXISTS queue;
+                        DROP TABLE IF EXISTS queue_versions;
+                        DROP TABLE IF EXISTS schema_version''')
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'favorites'")
+    if cur.fetchone():
+        cur.execute("DELETE FROM favorites")
+    con.commit()
+    queues.clear()
+    migrate()
+    # the version keeps counting up from where it was, so ETags and caches from before never match again
+    cur.execute("UPDATE library_meta SET version = ? WHERE id = 0", (version + 1,))
     con.commit()
     cur.close()
-
-
-def add_to_queue(song_name: str):  # (Ja) function that adds a song to the queue by its name
-    con = get_db_connection()
-    cur = con.cursor()
-    cur.execute("SELECT id FROM songs WHERE name = ?", (song_name,))  # (Ja) query for the song id using the song's name
-    song = cur.fetchone()
-
-    if song:
-        song_id = song[0]  # (Ja) extract the song id from the fetched result
-        cur.execute("SELECT MAX(position) FROM queue")
-        max_position = cur.fetchone()[0] or 0
-        new_position = max_position + 1
-        cur.execute("INSERT INTO queue (position, song_id) VALUES (?, ?)", (new_position, song_id))
+    con.close()
+    audio_paths.clear()
+    favorite_sets.clear()
+
+
+class EventBroadcaster:
+    """
+    Fan-out for the /api/events stream. Every event is serialized once when it is published and the same
+    bytes are handed to every subscriber. The last EVENT_HISTORY events are kept so a client that
+    reconnects with Last-Event-ID gets what it missed, and clients that are too far behind (or new) start
+    from a snapshot of the whole queue, which is also built once and shared until the next event.
+    Every queue has its own broadcaster, see QueueStore.events.
+    """
+
+    def __init__(self, owner=SHARED_QUEUE, history: int = EVENT_HISTORY):
+        self.owner = owner
+        self._condition = threading.Condition()
+        self._events = deque(maxlen=history)
+        self._seq = 0
+        self._snapshot = None
+        self._head = None
+        # (loop, asyncio.Event) of every subscribe_async() waiting for the next event
+        self._async_waiters = set()
+
+    def publish(self, event_type: str, data):
+        with self._condition:
+            self._seq += 1
+            payload = f"id: {self._seq}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n".encode()
+            self._events.append((self._seq, payload))
+            self._snapshot = None
+            self._condition.notify_all()
+            waiters = list(self._async_waiters)
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(waiter.set)
+
+    def snapshot(self):
+        # (seq, payload) of a 'snapshot' event holding the whole queue and the current song
+        with self._condition:
+            if self._snapshot is not None:
+                return self._snapshot
+            seq = self._seq
+        queue = [{"position": item[0], "title": item[1], "id": item[2]} for item in get_from_queue(self.owner)]
+        data = {"queue": queue, "current_song": current_song_details(self.owner)}
+        payload = f"id: {seq}\nevent: snapshot\ndata: {json.dumps(data)}\n\n".encode()
+        with self._condition:
+            if self._seq == seq:
+                self._snapshot = (seq, payload)
+        return seq, payload
+
+    def head_changed(self, head):
+        # remembers the entry at the front of the queue, True if it isn't the one seen last time
+        with self._condition:
+            changed = head != self._head
+            self._head = head
+            return changed
+
+    def _catch_up(self, last_id):
+        # the events a client reconnecting with last_id missed, or None if it has to start from a snapshot
+        with self._condition:
+            # ids past the newest event come from a broadcaster that was dropped and made again since
+            if last_id is None or last_id > self._seq or (self._events and self._events[0][0] > last_id + 1):
+                return None
+            return [event for event in self._events if event[0] > last_id]
+
+    def _pending(self, seq):
+        # events after seq, or None when some of them already fell out of the history
+        if self._events and self._events[0][0] > seq + 1:
+            return None
+        return [event for event in self._events if event[0] > seq]
+
+    def subscribe(self, last_id=None):
+        """
+        Generator of raw SSE bytes for one client: a snapshot (or the events missed since last_id),
+        then every new event as it is published, with a keep-alive comment when nothing happens.
+        """
+        missed = self._catch_up(last_id)
+        if missed is not None:
+            seq = last_id
+            for seq, payload in missed:
+                yield payload
+        else:
+            seq, payload = self.snapshot()
+            yield payload
+
+        while True:
+            with self._condition:
+                if self._seq == seq:
+                    self._condition.wait(timeout=EVENT_KEEPALIVE)
+                pending = self._pending(seq)
+            if pending is None:
+                seq, payload = self.snapshot()  # fell behind the history, start over from a snapshot
+                yield payload
+            elif pending:
+                for seq, payload in pending:
+                    yield payload
+            else:
+                yield b": keep-alive\n\n"
+
+    async def subscribe_async(self, last_id=None, run_db=None):
+        """
+        Same stream as subscribe() for asyncio servers: waiting for events doesn't take up a thread.
+        run_db(fn) runs the database work of building a snapshot off the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        with self._condition:
+            self._async_waiters.add(waiter)
+        try:
+            missed = self._catch_up(last_id)
+            if missed is not None:
+                seq = last_id
+                for seq, payload in missed:
+                    yield payload
+            else:
+                seq, payload = await run_db(self.snapshot)
+                yield payload
+
+            while True:
+                waiter[1].clear()
+                with self._condition:
+                    pending = self._pending(seq)
+                if pending is None:
+                    seq, payload = await run_db(self.snapshot)
+                    yield payload
+                elif pending:
+                    for seq, payload in pending:
+                        yield payload
+                else:
+                    try:
+                        await asyncio.wait_for(waiter[1].wait(), EVENT_KEEPALIVE)
+                    except asyncio.TimeoutError:
+                        yield b": keep-alive\n\n"
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+
+
+class QueueStore:
+    """
+    The play queues, one per (user id, device), held in memory so reading and changing a queue costs at
+    most one primary key lookup in SQLite. Each queue is a list of [sort_key, entry_id, song_id] in queue
+    order. The sort keys are what gets stored: adding puts a song one past the largest key and moving an
+    entry gives it a key halfway between its new neighbours, so every change rewrites a single row however
+    long the queue is. Entries are addressed by their id, which also keeps apart several copies of the
+    same song.
+
+    Changes are written behind: they go into a journal of entry id -> (owner, sort_key, song_id, new),
+    with a None sort key for removed entries, and a background thread writes the journal to the queue
+    table every QUEUE_FLUSH_INTERVAL seconds in one transaction. Several changes to one entry between
+    flushes become one write, and a crash loses at most one interval of changes. Queues are read from the
+    table the first time they are used, and past QUEUE_OWNERS_MAX the least recently used queues without
+    unwritten changes are dropped from memory.
+
+    Several processes can serve the same queues: every flush stamps the queues it wrote in queue_versions
+    with a number larger than any before, like library_meta does for the library. A queue whose stamp
+    differs from the one it was read at was changed by another process and is read again when it is next
+    used, and the background thread looks for such queues every interval so their /api/events
+    subscribers get a 'reset'. Changes made in another process show up once it has flushed them.
+    """
+
+    def __init__(self, max_queues: int = QUEUE_OWNERS_MAX):
+        self.max_queues = max_queues
+        self._queues = OrderedDict()
+        # the queue_versions stamp each queue in memory was read at or last written with
+        self._versions = {}
+        # largest stamp the background thread has looked at
+        self._seen = 0
+        # a queue's broadcaster lives as long as the queue is in memory or a client is subscribed to it
+        self._events = weakref.WeakValueDictionary()
+        self._held_events = {}
+        self._journal = {}
+        # entry ids this process may hand out, [_next_id, _id_limit)
+        self._next_id = self._id_limit = 0
+        self._lock = threading.RLock()
+        # one flush at a time, so the batches reach the database in the order they were taken
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+
+    def _load(self, owner):
+        # the entries of a queue, read from the database if it isn't in memory. Call with the lock held
+        entries = self._queues.get(owner)
+        if entries is not None:
+            self._queues.move_to_end(owner)
+            return entries
+        con = get_db_connection()
+        cur = con.cursor()
+        # one read transaction, so the stamp belongs to exactly these rows
+        cur.execute("BEGIN")
+        cur.execute(QUEUE_OF_DEVICE_SQL, owner)
+        entries = self._queues[owner] = [list(row) for row in cur.fetchall()]
+        cur.execute(QUEUE_VERSION_SQL, owner)
+        row = cur.fetchone()
         con.commit()
-        print(f"Added '{song_name}' to the queue.")
-        success = True
-    else:
-        print(f" Song: '{song_name}', was not found in the library.")  # (Ja) print a message if the songs not found
+        cur.close()
+        con.close()
+        self._versions[owner] = row[0] if row else 0
+        self._held_events[owner] = self.events(owner)
+        self._start()
+        return entries
 
-        print(
-            f"Error: Song '{song_name}' was not found in the library.")  # (Ja) print a message if the song's not found
-        success = False
+    def _stored_version(self, owner):
+        con = get_db_connection()
+        cur = con.cursor()
+        cur.execute(QUEUE_VERSION_SQL, owner)
+        row = cur.fetchone()
+        cur.close()
+        con.close()
+        return row[0] if row else 0
+
+    def _sync(self, owner):
+        """
+        Reads a queue in memory again if another process changed it since, unwritten changes of this
+        process are written first. Returns whether it was read again. Call without the lock held, since
+        it may flush.
+        """
+        with self._lock:
+            if owner not in self._queues:
+                return False
+            known = self._versions.get(owner, 0)
+        if self._stored_version(owner) == known:
+            return False
+        if self._unwritten(owner):
+            self.flush()
+        with self._lock:
+            if self._unwritten(owner):
+                return False  # changed again in the meantime, the next use tries again
+            self._queues.pop(owner, None)
+            self._load(owner)
+        publish_queue_event('reset', owner)
+        return True
+
+    def _unwritten(self, owner):
+        with self._lock:
+            return any(change[0] == owner for change in self._journal.values())
+
+    def _reserve_ids(self, count):
+        """
+        Takes the next block of entry ids from the queue table's sqlite_sequence row, so ids are never
+        handed out twice, not even by another process sharing the database, and an event id never means
+        two entries. Call with the lock held.
+        """
+        count = max(count, QUEUE_ID_BLOCK)
+        con = get_db_connection()
+        cur = con.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("SELECT MAX(id) FROM queue")
+            largest = cur.fetchone()[0] or 0
+            cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'queue'")
+            row = cur.fetchone()
+            first = max(largest, row[0] if row else 0) + 1
+            if row:
+                cur.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'queue'", (first + count - 1,))
+            else:
+                cur.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('queue', ?)", (first + count - 1,))
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            cur.close()
+            con.close()
+        self._next_id, self._id_limit = first, first + count
+
+    def _record(self, owner, entry, new=False):
+        """
+        Puts a changed entry into the journal. Entries added by this process are inserted by the flush,
+        other ones only updated, so a move can't bring back an entry another process removed. Call with
+        the lock held.
+        """
+        previous = self._journal.get(entry[1])
+        self._journal[entry[1]] = (owner, entry[0], entry[2], new or (previous is not None and previous[3]))
+
+    def _index(self, entries, entry_id=None, position=None):
+        # list index of an entry by its id or 1-based position, or None
+        if entry_id is None:
+            return position - 1 if position is not None and 1 <= position <= len(entries) else None
+        for index, entry in enumerate(entries):
+            if entry[1] == entry_id:
+                return index
+        return None
+
+    def _written(self):
+        # starts the background writer on the first change, or writes right away when the interval is 0
+        if app.config['QUEUE_FLUSH_INTERVAL'] <= 0:
+            self.flush()
+        else:
+            self._start()
+
+    def _start(self):
+        if self._flusher is None and app.config['QUEUE_FLUSH_INTERVAL'] > 0:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._run, name="queue-flush", daemon=True)
+                    self._flusher.start()
+                    atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.wait(app.config['QUEUE_FLUSH_INTERVAL']):
+            try:
+                self.flush()
+                self._poll()
+            except Exception as e:
+                log.exception("Could not write queue changes. Error: %s", e)
+
+    def _poll(self):
+        # reads again the queues in memory that other processes changed since the last poll
+        con = get_db_connection()
+        cur = con.cursor()
+        cur.execute("SELECT user_id, device, version FROM queue_versions WHERE version > ?", (self._seen,))
+        rows = cur.fetchall()
+        cur.close()
+        con.close()
+        for user_id, device, version in rows:
+            self._seen = max(self._seen, version)
+            with self._lock:
+                stale = (user_id, device) in self._queues and self._versions.get((user_id, device)) != version
+            if stale:
+                self._sync((user_id, device))
+
+    def events(self, owner):
+        # the /api/events broadcaster of a queue
+        with self._lock:
+            broadcaster = self._events.get(owner)
+            if broadcaster is None:
+                broadcaster = self._events[owner] = EventBroadcaster(owner)
+            return broadcaster
+
+    def entries(self, owner, limit: int = None):
+        # (entry_id, song_id) of every entry in queue order, or of the first `limit` ones
+        self._sync(owner)
+        with self._lock:
+            return [(entry[1], entry[2]) for entry in self._load(owner)[:limit]]
+
+    def head(self, owner):
+        # (entry_id, song_id) at the front of the queue, or None
+        self._sync(owner)
+        with self._lock:
+            entries = self._load(owner)
+            return (entries[0][1], entries[0][2]) if entries else None
+
+    def add(self, owner, song_ids):
+        # appends the songs in order, returns their new entry ids
+        self._sync(owner)
+        with self._lock:
+            entries = self._load(owner)
+            if self._next_id + len(song_ids) > self._id_limit:
+                self._reserve_ids(len(song_ids))
+            key = entries[-1][0] if entries else 0
+            added = []
+            for song_id in song_ids:
+                key += 1
+                entry = [key, self._next_id, song_id]
+                self._next_id += 1
+                entries.append(entry)
+                self._record(owner, entry, new=True)
+                added.append(entry[1])
+        self._written()
+        return added
+
+    def remove(self, owner, entry_id=None, position=None):
+        # removes one entry by its id or position, returns its id or None if there is no such entry
+        self._sync(owner)
+        with self._lock:
+            entries = self._load(owner)
+            index = self._index(entries, entry_id, position)
+            if index is None:
+                return None
+            entry = entries.pop(index)
+            self._journal[entry[1]] = (owner, None, None, False)
+        self._written()
+        return entry[1]
+
+    def move(self, owner, to_position: int, entry_id=None, from_position=None):
+        """
+        Moves one entry (by id, or by its current position) so that it ends up at to_position, giving it
+        a sort key between its new neighbours. Returns (status, entry_id) where status is 'moved',
+        'unchanged' or 'missing'.
+        """
+        self._sync(owner)
+        with self._lock:
+            entries = self._load(owner)
+            index = self._index(entries, entry_id, from_position)
+            if index is None:
+                return 'missing', entry_id
+            target = min(max(to_position, 1), len(entries)) - 1
+            if target == index:
+                return 'unchanged', entries[index][1]
+            entry = entries.pop(index)
+            before = entries[target - 1][0] if target > 0 else None
+            after = entries[target][0] if target < len(entries) else None
+            entries.insert(target, entry)
+            if before is None:
+                entry[0] = after - 1
+            elif after is None:
+                entry[0] = before + 1
+            else:
+                entry[0] = (before + after) / 2
+            if before is not None and after is not None and not before < entry[0] < after:
+                # ran out of float precision between the two neighbours, spread all the keys out again
+                for key, other in enumerate(entries, start=1):
+                    other[0] = key
+                    self._record(owner, other)
+            else:
+                self._record(owner, entry)
+        self._written()
+        return 'moved', entry[1]
+
+    def drop_songs(self, song_ids):
+        """
+        Removes every entry of the songs from the queues in memory and returns the owners whose queue
+        changed. Entries of queues that aren't in memory have to be deleted from the table by the caller.
+        """
+        song_ids = set(song_ids)
+        changed = []
+        with self._lock:
+            for owner, entries in self._queues.items():
+                kept = [entry for entry in entries if entry[2] not in song_ids]
+                if len(kept) == len(entries):
+                    continue
+                for entry in entries:
+                    if entry[2] in song_ids:
+                        self._journal[entry[1]] = (owner, None, None, False)
+                entries[:] = kept
+                changed.append(owner)
+        if changed:
+            self._written()
+        return changed
+
+    def clear(self):
+        # forgets every queue and unwritten change, for when the queue table is dropped
+        with self._lock:
+            self._queues.clear()
+            self._versions.clear()
+            self._held_events.clear()
+            self._journal.clear()
+            self._next_id = self._id_limit = 0
+            self._seen = 0
+
+    def flush(self):
+        # writes the journal to the queue table in one transaction, returns how many entries were written
+        with self._flush_lock:
+            with self._lock:
+                batch, self._journal = self._journal, {}
+            if not batch:
+                return 0
+            inserted = [(entry_id, key, song_id, owner[0], owner[1])
+                        for entry_id, (owner, key, song_id, new) in batch.items() if key is not None and new]
+            updated = [(key, entry_id)
+                       for entry_id, (owner, key, song_id, new) in batch.items() if key is not None and not new]
+            removed = [(entry_id,) for entry_id, (owner, key, song_id, new) in batch.items() if key is None]
+            owners = {change[0] for change in batch.values()}
+            con = get_db_connection()
+            cur = con.cursor()
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+                cur.executemany('''INSERT OR REPLACE INTO queue (id, sort_key, song_id, user_id, device)
+                                   VALUES (?, ?, ?, ?, ?)''', inserted)
+                cur.executemany("UPDATE queue SET sort_key = ? WHERE id = ?", updated)
+                cur.executemany("DELETE FROM queue WHERE id = ?", removed)
+                # every queue written gets the same new stamp, larger than any other
+                cur.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM queue_versions")
+                stamp = cur.fetchone()[0]
+                before = {}
+                for owner in owners:
+                    cur.execute(QUEUE_VERSION_SQL, owner)
+                    row = cur.fetchone()
+                    before[owner] = row[0] if row else 0
+                cur.executemany('''INSERT INTO queue_versions (user_id, device, version) VALUES (?, ?, ?)
+                                   ON CONFLICT (user_id, device) DO UPDATE SET version = excluded.version''',
+                                [(owner[0], owner[1], stamp) for owner in owners])
+                con.commit()
+            except sql.Error as e:
+                con.rollback()
+                # keeps the changes for the next flush, unless the entries changed again in the meantime
+                with self._lock:
+                    for entry_id, change in batch.items():
+                        current = self._journal.setdefault(entry_id, change)
+                        if change[3] and current[1] is not None:
+                            self._journal[entry_id] = (*current[:3], True)
+                log_sampled(logging.WARNING, "queue flush", "Could not write %d queue changes. Error: %s",
+                            len(batch), e)
+                return 0
+            finally:
+                cur.close()
+                con.close()
+            with self._lock:
+                for owner in owners:
+                    # queues nobody else wrote to since they were read are still current here
+                    if owner in self._queues and self._versions.get(owner) == before[owner]:
+                        self._versions[owner] = stamp
+            queue_writes_total.inc(len(batch))
+            self._evict()
+            return len(batch)
+
+    def _evict(self):
+        with self._lock:
+            unwritten = {change[0] for change in self._journal.values()}
+            for owner in list(self._queues):
+                if len(self._queues) <= self.max_queues:
+                    break
+                if owner not in unwritten:
+                    del self._queues[owner]
+                    self._versions.pop(owner, None)
+                    self._held_events.pop(owner, None)
+
+    def stop(self):
+        # stops the background writer and writes what is left, runs at exit
+        self._stopped.set()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {"queues": len(self._queues), "unwritten": len(self._journal),
+                    "event_history": sum(len(broadcaster._events) for broadcaster in self._events.values())}
+
+
+queues = QueueStore()
+
+
+def token_user_id(token):
+    # id of the user a token belongs to, or None if there is no token or it isn't valid
+    if not token:
+        return None
+    try:
+        return decode_token(token)
+    except (jwt.InvalidTokenError, KeyError):
+        return None
+
+
+def queue_owner_for(token, device=None):
+    # (user id, device) of the queue a client with this token and device id works on
+    user_id = token_user_id(token)
+    if user_id is None:
+        return SHARED_QUEUE
+    return user_id, (device or QUEUE_DEFAULT_DEVICE)[:QUEUE_DEVICE_MAX_LENGTH]
+
+
+def queue_owner():
+    """
+    Whose queue a request works on: logged-in users (bearer token) have one queue per device, named by
+    the X-Device-Id header or ?device=, and requests without a valid token share one queue. EventSource
+    can't send headers, so /api/events also takes the token as ?token=.
+    """
+    token = get_bearer_token() or (request.args.get('token') if request.endpoint == 'queue_events' else None)
+    return queue_owner_for(token, request.headers.get('X-Device-Id') or request.args.get('device'))
+
+
+def publish_queue_event(op: str, owner=SHARED_QUEUE, **details):
+    """
+    Tells the /api/events subscribers of a queue how it changed ('add', 'extend' with several added
+    entries, 'remove', 'move' or 'reset' with the whole queue) and, when the song at the front of the
+    queue is a different one now, what the new current song is.
+    """
+    broadcaster = queues.events(owner)
+    if op == 'reset':
+        details['queue'] = [{"position": item[0], "title": item[1], "id": item[2]} for item in get_from_queue(owner)]
+    broadcaster.publish('queue', {"op": op, **details})
+
+    head = queues.head(owner)
+    if broadcaster.head_changed(head[0] if head else None):
+        broadcaster.publish('current_song', current_song_details(owner))
+    # the songs coming up may have changed, get their transcodes going before they are asked for
+    queue_prewarm(owner)
+
+
+@app.route('/api/events', methods=['GET'])
+def queue_events():
+    """
+    Server-sent events stream of queue changes ('queue' events carrying a diff) and current song
+    changes ('current_song' events), so clients don't have to poll /api/queue and /api/current_song.
+    The first event is a 'snapshot' with the whole queue and current song.
+    """
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    response = app.response_class(queues.events(queue_owner()).subscribe(last_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # keeps nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def add_to_queue(song_name: str, owner=SHARED_QUEUE):  # (Ja) function that adds a song to the queue by its name
+    song = song_cache.get_by_name(song_name)  # look up the song id using the song's name
 
-    cur.close()
-    return success
+    if song:
+        entry_id, = queues.add(owner, [song.id])
+        log_sampled(logging.DEBUG, "queue add", "Added '%s' to the queue.", song_name)
+        publish_queue_event('add', owner, entry={"id": entry_id, "title": song_name})
+        return True
+    # log a message if the song's not found
+    log_sampled(logging.INFO, "queue add missing", "Song '%s' was not found in the library.", song_name)
+    return False
 
 
 @app.route("/api/add_to_queue", methods=["POST"])
@@ -313,111 +1998,367 @@ def api_add_to_queue():
     if not song_name:
         return jsonify({"error": "Song name is required"}), 400  # (Ja) returning an error if song name is not provided
     # (Ja) calling the add_to_queue function and getting the result
-    result = add_to_queue(song_name)
+    result = add_to_queue(song_name, queue_owner())
     if result:
         return jsonify({"message": ["success"]}), 200  # (Ja) success response
     else:
         return jsonify({"error": ["song not found"]}), 404  # (Ja) error response, if song not found
 
 
-def remove_from_queue(position: int):  # (Ja) function that removes a song from the queue based on its position
+def bulk_queue_songs(cur, data):
+    """
+    (id, name) of the songs a /api/queue/bulk request asks for, in the order they get queued:
+    -ids in the given order, unknown ids are skipped
+    -album_id in file order, which follows the track numbers for most rips
+    -artist_id album by album, each in file order
+    -search the same songs /api/search ranks first for that query
+    """
+    if data.get('ids') is not None:
+        song_ids = data['ids']
+        cur.execute(f"SELECT id, name FROM songs WHERE id IN ({','.join('?' * len(song_ids))})", song_ids)
+        names = dict(cur.fetchall())
+        return [(song_id, names[song_id]) for song_id in song_ids if song_id in names]
+    if data.get('album_id') is not None:
+        cur.execute(ALBUM_SONGS_SQL, (data['album_id'], QUEUE_BULK_MAX))
+    elif data.get('artist_id') is not None:
+        cur.execute(ARTIST_SONGS_SQL, (data['artist_id'], QUEUE_BULK_MAX))
+    else:
+        cur.execute('''SELECT songs.id, songs.name FROM songs_fts
+                       JOIN songs ON songs.id = songs_fts.rowid
+                       WHERE songs_fts MATCH ?
+                       ORDER BY bm25(songs_fts, 10.0, 4.0, 2.0) LIMIT ?''',
+                    (build_search_query(data['search']), QUEUE_BULK_MAX))
+    return cur.fetchall()
+
+
+def add_many_to_queue(data, owner=SHARED_QUEUE):
+    """
+    Queues every song bulk_queue_songs finds for the request after the current end of the queue, in
+    that order. Returns the new entries as {"id", "title"} dictionaries.
+    """
     con = get_db_connection()
     cur = con.cursor()
-
-    # (Ja) checking if there’s a song at the specified position before deleting
-    cur.execute("SELECT * FROM queue WHERE position = ?", (position,))
-    song_exists = cur.fetchone() is not None
-
-    # (Ja) if the song exists at the position, delete it
-    if song_exists:
-        cur.execute("DELETE FROM queue WHERE position = ?",
-                    (position,))  # (Ja) delete the song at the specified position in the queue
-        cur.execute("""
-            UPDATE queue
-            SET position = position - 1
-            WHERE position > ?
-        """, (position,))
-        con.commit()
-        message = f"Removed song at position {position} from the queue."
-        success = True
-    else:
-        message = f"No song found at position {position} in the queue."
-        success = False
-
+    songs = bulk_queue_songs(cur, data)
     cur.close()
     con.close()
+    entry_ids = queues.add(owner, [song_id for song_id, name in songs])
+    entries = [{"id": entry_id, "title": name} for entry_id, (song_id, name) in zip(entry_ids, songs)]
+    if entries:
+        publish_queue_event('extend', owner, entries=entries)
+    return entries
+
+
+def is_integer(value):
+    # JSON numbers that are whole numbers, true and false are ints in Python but not positions or ids
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+@app.route("/api/queue/bulk", methods=["POST"])
+def api_add_many_to_queue():
+    """
+    Queues many songs with one request: {"ids": [...]}, {"album_id": n}, {"artist_id": n} or
+    {"search": "text"}, at most QUEUE_BULK_MAX songs. Answers with the added entries and the whole queue.
+    """
+    data = request.get_json(silent=True) or {}
+    sources = [key for key in ('ids', 'album_id', 'artist_id', 'search') if data.get(key) is not None]
+    if len(sources) != 1:
+        return jsonify({"error": "Exactly one of 'ids', 'album_id', 'artist_id' or 'search' is required"}), 400
+    if sources == ['ids'] and not (isinstance(data['ids'], list) and all(map(is_integer, data['ids']))):
+        return jsonify({"error": "'ids' must be a list of integers"}), 400
+    if sources == ['ids'] and len(data['ids']) > QUEUE_BULK_MAX:
+        return jsonify({"error": f"At most {QUEUE_BULK_MAX} ids can be queued at once"}), 400
+    if sources[0] in ('album_id', 'artist_id') and not is_integer(data[sources[0]]):
+        return jsonify({"error": f"'{sources[0]}' must be an integer"}), 400
+    if sources == ['search'] and not (isinstance(data['search'], str) and build_search_query(data['search'])):
+        return jsonify({"error": "'search' must contain at least one word"}), 400
+
+    owner = queue_owner()
+    try:
+        entries = add_many_to_queue(data, owner)
+    except sql.Error as e:
+        return jsonify({"error": f"An error occurred: {e}"}), 500
+    if not entries:
+        return jsonify({"error": "No songs found"}), 404
+
+    queue = [{"position": item[0], "title": item[1], "id": item[2]} for item in get_from_queue(owner)]
+    return jsonify({"added": entries, "queue": queue}), 200
 
-    return {"success": success, "message": message}
+
+def remove_from_queue(position: int = None, entry_id: int = None, owner=SHARED_QUEUE):  # (Ja) function that removes a song from the queue based on its position
+    # if there's a song at the specified position (or with that entry id), remove it. The entries after it move up on their own
+    removed = queues.remove(owner, entry_id, position)
+    if removed is not None:
+        publish_queue_event('remove', owner, id=removed)
+        return {"success": True, "message": f"Removed queue entry {removed} from the queue."}
+    return {"success": False, "message": f"No song found at position {position} in the queue."}
 
 
 @app.route("/api/remove_from_queue", methods=["DELETE"])
 def api_remove_from_queue():
     data = request.json  # (Ja) getting the json data from the request
     position = data.get("position")  # (Ja) getting the position from the json data
-    if position is None:
-        return jsonify({"error": "Position is required"}), 400  # (Ja) returning an error if position is not provided
+    entry_id = data.get("entry_id")
+    if position is None and entry_id is None:
+        return jsonify({"error": "Position or entry_id is required"}), 400  # (Ja) returning an error if position is not provided
+    if not all(value is None or is_integer(value) for value in (position, entry_id)):
+        return jsonify({"error": "'position' and 'entry_id' must be integers"}), 400
     # (Ja) calling the remove_from_queue function
-    remove_from_queue(position)
-    return jsonify({"message": f"Removed song at position {position} from the queue"}), 200
+    result = remove_from_queue(position, entry_id, queue_owner())
+    if not result["success"]:
+        return jsonify({"error": result["message"]}), 404
+    return jsonify({"message": result["message"]}), 200
+
+
+def move_in_queue(to_position: int, entry_id: int = None, from_position: int = None, owner=SHARED_QUEUE):
+    """
+    Moves one queue entry (by entry id, or by its current position) so that it ends up at to_position,
+    see QueueStore.move. Returns (status, message) where status is 'moved', 'unchanged' or 'missing'.
+    """
+    status, entry_id = queues.move(owner, to_position, entry_id, from_position)
+    if status == 'missing':
+        return 'missing', f"No song found at position {from_position}" if from_position else f"No queue entry {entry_id}"
+    if status == 'unchanged':
+        return 'unchanged', "Song is already at the desired position"
+    publish_queue_event('move', owner, id=entry_id, to_position=max(to_position, 1))
+    return 'moved', f"Moved queue entry {entry_id} to position {to_position}"
+
+
+def get_from_queue(owner=SHARED_QUEUE):  # (Jo) will retrieve the current queue
+    # (position, title, entry id) of every entry, the titles come from the song cache
+    entries = queues.entries(owner)
+    songs = song_cache.get_many([song_id for entry_id, song_id in entries])
+    queue = [(entry_id, songs[song_id].name) for entry_id, song_id in entries if song_id in songs]
+    return [(position, name, entry_id) for position, (entry_id, name) in enumerate(queue, start=1)]
+
+
+@app.route('/api/queue', methods=['GET'])
+def get_queue():
+    queue = get_from_queue(queue_owner())
+    queue_list = [{"position": item[0], "title": item[1], "id": item[2]} for item in queue]
+
+    return jsonify(queue_list), 200
 
 
-def get_from_queue():  # (Jo) will retrieve the current queue
+def warm_page_cache(paths):
+    # asks the kernel to start reading the files into the page cache, so they are in memory when requested
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+@app.route('/api/queue/upcoming', methods=['GET'])
+def get_upcoming():
+    """
+    The first ?n= queue entries with everything the player needs to start them, read with one query:
+    the song's details plus its audio and cover art URLs, duration, size in bytes and the ETag its audio
+    is served with. Their audio paths are cached for the audio requests that follow, and unless
+    UPCOMING_READAHEAD is off the files are read ahead into the page cache.
+    """
+    n = max(1, min(request.args.get('n', UPCOMING_DEFAULT, type=int), UPCOMING_MAX))
+    entries = queues.entries(queue_owner(), limit=n)
+    song_ids = [song_id for entry_id, song_id in entries]
     con = get_db_connection()
     cur = con.cursor()
-    cur.execute(''' SELECT queue.position, songs.name FROM queue
-                JOIN songs ON queue.song_id = songs.id
-                ORDER BY  queue.position ASC''')
-    queue = cur.fetchall()
+    cur.execute(f'''SELECT songs.id, songs.name, artists.name, albums.name, songs.length, songs.path,
+                           songs.cover_art, songs.size, songs.hash, songs.mtime
+                    FROM songs
+                    LEFT JOIN artists ON songs.artist_id = artists.id
+                    LEFT JOIN albums ON songs.album_id = albums.id
+                    WHERE songs.id IN ({','.join('?' * len(song_ids))})''', song_ids)
+    rows = {row[0]: row for row in cur.fetchall()}
     cur.close()
     con.close()
-    return queue
-
 
-@app.route('/api/queue', methods=['GET'])
-def get_queue():
-    queue = get_from_queue()
-    queue_list = [{"position": item[0], "title": item[1]} for item in queue]
-    print(queue)
+    music_folder = os.path.abspath(music_directory)
+    upcoming = []
+    paths = []
+    for entry_id, song_id in entries:
+        row = rows.get(song_id)
+        if row is None:
+            continue
+        path, cover_art, size, content_hash, mtime = row[5:]
+        song = SongRecord(row[:7]).to_dict()
+        file_path = safe_join(music_folder, path)
+        if file_path is not None:
+            audio_paths.put(('id', song_id), (file_path, content_hash, mtime))
+            paths.append(file_path)
+        song.update({
+            "position": len(upcoming) + 1,
+            "entry_id": entry_id,
+            "audio_url": url_for('serve_audio_by_id', song_id=song_id),
+            "cover_art_url": url_for('serve_cover_art', filename=os.path.basename(cover_art)) if cover_art else None,
+            "duration": row[4],
+            "size": size,
+            # songs from before content hashes were stored get a validator made from the file when served
+            "etag": quote_etag(content_hash) if content_hash else None,
+        })
+        upcoming.append(song)
+
+    if app.config['UPCOMING_READAHEAD']:
+        warm_page_cache(paths)
+    return jsonify(upcoming), 200
+
+
+class SongIdIndex:
+    """
+    All song ids kept in memory so a random pick is O(1). Ids live in a dense list with a dict from id to
+    its slot, so removing one swaps the last id into its slot instead of shifting the list. Each use
+    compares the library version with the one the index was built at; new songs are picked up by reading
+    the ids above the largest one known (ids only grow), and a full reload only happens when songs were
+    removed somewhere that didn't call remove(), like another process.
+    """
+
+    def __init__(self, recent: int = RANDOM_RECENT_WINDOW):
+        self._ids = []
+        self._slots = {}
+        self._max_id = 0
+        self._recent = deque(maxlen=recent)
+        self._version = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        con = get_db_connection()
+        cur = con.cursor()
+        version = get_library_version(cur)
+        with self._lock:
+            if version != self._version:
+                cur.execute("SELECT id FROM songs WHERE id > ? ORDER BY id", (self._max_id,))
+                for row in cur.fetchall():
+                    self._add(row[0])
+                cur.execute("SELECT COUNT(*) FROM songs")
+                if cur.fetchone()[0] != len(self._ids):
+                    cur.execute("SELECT id FROM songs ORDER BY id")
+                    self._ids, self._slots, self._max_id = [], {}, 0
+                    self._recent.clear()
+                    for row in cur.fetchall():
+                        self._add(row[0])
+                self._version = version
+        cur.close()
+        con.close()
 
-    return jsonify(queue_list), 200
+    def _add(self, song_id):
+        if song_id not in self._slots:
+            self._slots[song_id] = len(self._ids)
+            self._ids.append(song_id)
+            self._recent.append(song_id)
+            self._max_id = max(self._max_id, song_id)
+
+    def remove(self, song_ids):
+        with self._lock:
+            for song_id in song_ids:
+                slot = self._slots.pop(song_id, None)
+                if slot is None:
+                    continue
+                last = self._ids.pop()
+                if last != song_id:
+                    self._ids[slot] = last
+                    self._slots[last] = slot
+
+    def __contains__(self, song_id):
+        return song_id in self._slots
+
+    def ids(self):
+        with self._lock:
+            return list(self._ids)
+
+    def choice(self):
+        with self._lock:
+            return random.choice(self._ids) if self._ids else None
+
+    def recent_choice(self):
+        # one of the most recently added songs that is still in the library
+        with self._lock:
+            for _ in range(8):
+                if not self._recent:
+                    return None
+                song_id = self._recent[random.randrange(len(self._recent))]
+                if song_id in self._slots:
+                    return song_id
+            return None
+
+
+song_ids = SongIdIndex()
+# per-session shuffle bags for /api/random_song?mode=shuffle, oldest sessions are dropped first
+shuffle_bags = OrderedDict()
+shuffle_bags_lock = threading.Lock()
+
+
+def shuffle_bag_choice(session: str):
+    """
+    Next song of a session's shuffle bag. The bag holds every song in random order and is refilled only
+    once it is empty, so no song repeats until the whole library has played. Refilling is O(n) once per
+    pass through the library, which makes each pick O(1) on average.
+    """
+    with shuffle_bags_lock:
+        bag = shuffle_bags.pop(session, None)
+        if bag is None and len(shuffle_bags) >= SHUFFLE_BAG_SESSIONS:
+            shuffle_bags.popitem(last=False)
+    song_id = None
+    for attempt in range(2):
+        while bag:
+            candidate = bag.pop()
+            if candidate in song_ids:  # skips songs removed since the bag was filled
+                song_id = candidate
+                break
+        if song_id is not None:
+            break
+        bag = song_ids.ids()
+        random.shuffle(bag)
+    with shuffle_bags_lock:
+        shuffle_bags[session] = bag or []
+    return song_id
+
+
+def favorite_choice(user_id):
+    # random favorite of the user, or None
+    favorites = [song_id for song_id in favorite_sets.get(user_id)[0] if song_id in song_ids]
+    return random.choice(favorites) if favorites else None
 
 
 @app.route("/api/random_song", methods=[
     "GET"])  # (N) API endpoint for getting a random song that will be used temporarily for the forward and backward buttons
 def get_random_song():  # (N) function for getting a random song
-    con = get_db_connection()
-    cur = con.cursor()
-    cur.execute(
-        "SELECT id FROM songs")  # (N) get a list of every song and then select all of the song_ids from that list
-    song_ids = [row[0] for row in cur.fetchall()]
-
-    if song_ids:
-        random_song_id = random.choice(song_ids)  # (N) grab a random song id and then add that song into the queue
-        # cur.execute("INSERT INTO queue (song_id) VALUES (?)", (random_song_id,))
-        con.commit()
+    """
+    ?mode= picks how the song is chosen:
+    -uniform (default) any song with the same chance
+    -shuffle plays through a per-session shuffle bag (session from ?session= or the X-Session-Id header)
+    -favorites picks one of the logged in user's favorites RANDOM_FAVORITES_WEIGHT of the time
+    -recent picks one of the RANDOM_RECENT_WINDOW newest songs RANDOM_RECENT_WEIGHT of the time
+    """
+    song_ids.refresh()
+    mode = request.args.get('mode', 'uniform')
+
+    random_song_id = None
+    if mode == 'shuffle':
+        session = request.args.get('session') or request.headers.get('X-Session-Id') or request.remote_addr
+        random_song_id = shuffle_bag_choice(session)
+    elif mode == 'favorites' and random.random() < RANDOM_FAVORITES_WEIGHT:
+        user_id = request_user_id()
+        if user_id is not None:
+            random_song_id = favorite_choice(user_id)
+    elif mode == 'recent' and random.random() < RANDOM_RECENT_WEIGHT:
+        random_song_id = song_ids.recent_choice()
+    if random_song_id is None:
+        random_song_id = song_ids.choice()  # (N) grab a random song id
+    if random_song_id is None:
+        return jsonify({"error": "No songs found"}), 404
 
     # (N) get all the relevant metadata from that song
-    cur.execute('''SELECT songs.name, artists.name AS artist, albums.name AS album, 
-                                  songs.length, songs.path, songs.cover_art 
-                           FROM songs
-                           LEFT JOIN artists ON songs.artist_id = artists.id
-                           LEFT JOIN albums ON songs.album_id = albums.id
-                           WHERE songs.id = ?''', (random_song_id,))
-
-    song_details = cur.fetchone()  # (N) add it to a variable
-    cur.close()
-    con.close()
+    song_details = song_cache.get(random_song_id)
 
     if song_details:  # (N) if those details are valid use jsonify to put it into JSON format to respond to the API call
         # (N) giving all of the information needed by the frontend
-        return jsonify({
-            "title": song_details[0] or "Unknown Title",
-            "artist": song_details[1] or "Unknown Artist",
-            "album": song_details[2] or "Unknown Album",
-            "length": song_details[3] or "Unknown Length",
-            "path": song_details[4],
-            "cover_art": song_details[5]
-        }), 200
+        return jsonify(song_details.to_dict()), 200
     # (N) if there was an error getting that information return an error
     else:
         return jsonify({"error": "No songs found"}), 404
@@ -425,75 +2366,415 @@ def get_random_song():  # (N) function for getting a random song
 
 @app.route("/api/song/<song_name>", methods=["GET"])
 def get_song_by_name(song_name):
-    con = get_db_connection()
-    cur = con.cursor()
-
-    cur.execute('''SELECT songs.name, artists.name, albums.name, songs.length, songs.path, songs.cover_art
-                   FROM songs
-                   LEFT JOIN artists ON songs.artist_id = artists.id
-                   LEFT JOIN albums ON songs.album_id = albums.id
-                   WHERE songs.name = ?;''', (song_name,))
-
-    song = cur.fetchone()
-    cur.close()
-    con.close()
+    song = song_cache.get_by_name(song_name)
 
     if song:
-        return jsonify({
-            "title": song[0] or "Unknown Title",
-            "artist": song[1] or "Unknown Artist",
-            "album": song[2] or "Unknown Album",
-            "length": song[3] or "Unknown Length",
-            "path": song[4],
-            "cover_art": song[5]
-        }), 200
+        return jsonify(song.to_dict()), 200
     else:
         return jsonify({"message": "No song found"}), 404
 
 
+@app.route("/api/songs", methods=["POST"])
+def get_songs():
+    """
+    Resolves many songs in one call so the frontend doesn't need a /api/song request per queue entry.
+    Takes {"ids": [...]} and/or {"names": [...]} (at most SONG_BATCH_MAX in total) and answers
+    {"songs": [...]} with one entry per requested id and then per requested name, in the same order,
+    null where there is no such song.
+    """
+    data = request.get_json(silent=True) or {}
+    song_ids = data.get('ids') or []
+    names = data.get('names') or []
+    if not isinstance(song_ids, list) or not isinstance(names, list):
+        return jsonify({"error": "'ids' and 'names' must be lists"}), 400
+    if len(song_ids) + len(names) > SONG_BATCH_MAX:
+        return jsonify({"error": f"At most {SONG_BATCH_MAX} songs per request"}), 400
+    if not all(isinstance(song_id, int) for song_id in song_ids) or not all(isinstance(name, str) for name in names):
+        return jsonify({"error": "'ids' must be integers and 'names' strings"}), 400
+
+    by_id = song_cache.get_many(song_ids) if song_ids else {}
+    by_name = song_cache.get_many_by_name(names) if names else {}
+    songs = [by_id.get(song_id) for song_id in song_ids] + [by_name.get(name) for name in names]
+    songs = flag_favorites([song.to_dict() if song else None for song in songs], request_favorites())
+    return jsonify({"songs": songs}), 200
+
+
+def current_song_details(owner=SHARED_QUEUE):
+    # details of the first song in the queue as a dictionary, or None if the queue is empty. Its metadata
+    # comes from the song cache
+    head = queues.head(owner)
+    current_song = song_cache.get(head[1]) if head else None
+    return current_song.to_dict() if current_song else None
+
+
 @app.route("/api/current_song",
            methods=["GET"])  # (N) api endpoint that gets information related to the currently playing song in the queue
 def get_current_song():
-    con = get_db_connection()
-    cur = con.cursor()
-    # (Ja) execute SQL query to get the first song in the queue, joining the songs, artists and albums tables to retrieve full metadata
-    cur.execute('''SELECT songs.name, artists.name, albums.name, songs.length, songs.path, songs.cover_art
-                   FROM queue
-                   JOIN songs ON queue.song_id = songs.id
-                   LEFT JOIN artists ON songs.artist_id = artists.id
-                   LEFT JOIN albums ON songs.album_id = albums.id
-                   ORDER BY queue.position ASC LIMIT 1;''')
-    # (Ja) fetches first song in queue, if it exists
-    current_song = cur.fetchone()
-    cur.close()
-    con.close()
+    current_song = current_song_details(queue_owner())
 
     # (Ja) if the song is retrieved from the query, return its details
     if current_song:  # (N) use jsonify to give all of the information in JSON response format so that it can be accessed by the frontend
-        return jsonify({
-            "title": current_song[0] or "Unknown Title",
-            "artist": current_song[1] or "Unknown Artist",
-            "album": current_song[2] or "Unknown Album",
-            "length": current_song[3] or "Unknown Length",
-            "path": current_song[4],
-            "cover_art": current_song[5]
-        }), 200
+        return jsonify(current_song), 200
     else:
         # (Ja) if there's no songs in the queue return None 
         return jsonify({"message": "No songs in the queue!"}), 404
 
 
-@app.route('/api/audio/<path:filename>')
-def serve_audio(filename):
-    # (Ja) dynamically get the music dir
-    music_folder = os.path.abspath("Music")
+class AudioPathCache:
+    """
+    Remembers where the audio file for a song id or a /api/audio filename lives on disk, together with
+    its content hash and mtime from the song's fingerprint, so serving audio doesn't have to resolve
+    paths, check the disk or query the database on every request. Bounded LRU; anything that changes
+    the library calls clear().
+    """
+
+    def __init__(self, size: int = AUDIO_PATH_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+audio_paths = AudioPathCache()
+
+
+def resolve_audio(key):
+    """
+    Returns (absolute path, etag, mtime) for ('id', song_id) or ('file', filename) keys, or None if
+    there is no such audio file. Only the first request for a key touches the database and the disk.
+    """
+    entry = audio_paths.get(key)
+    if entry is not None:
+        return entry
+
+    music_folder = os.path.abspath(music_directory)
+    con = get_db_connection()
+    cur = con.cursor()
+    if key[0] == 'id':
+        cur.execute("SELECT path, hash, mtime FROM songs WHERE id = ?", (key[1],))
+    else:
+        cur.execute("SELECT path, hash, mtime FROM songs WHERE path = ?", (key[1],))
+    row = cur.fetchone()
+    cur.close()
+    con.close()
+
     # (Ja) construct the full file path
-    file_path = os.path.join(music_folder, filename)
-    print(f"Requested file path: {file_path}")
-    if not os.path.isfile(file_path):
-        print(f"File not found: {file_path}")
+    # safe_join refuses anything that points outside the music folder
+    relative_path = row[0] if row else key[1] if key[0] == 'file' else None
+    file_path = safe_join(music_folder, relative_path) if relative_path else None
+    if file_path is None or not os.path.isfile(file_path):
+        return None
+    # files that aren't indexed yet fall back to werkzeug's own etag
+    entry = (file_path, row[1] if row else None, row[2] if row else None)
+    audio_paths.put(key, entry)
+    return entry
+
+
+def send_audio(key):
+    """
+    Sends an audio file with byte-range (206) support and ETag/Last-Modified validators. With
+    AUDIO_ACCEL_REDIRECT set the transfer is handed to nginx through X-Accel-Redirect, with
+    USE_X_SENDFILE to the server through X-Sendfile, otherwise werkzeug streams the file through the
+    server's wsgi.file_wrapper, which uses sendfile() where the server supports it.
+    """
+    entry = resolve_audio(key)
+    if entry is None:
         abort(404, description="File not found")
-    return send_file(file_path)
+    file_path, etag, mtime = entry
+
+    accel_prefix = app.config.get('AUDIO_ACCEL_REDIRECT')
+    if accel_prefix:
+        relative_path = os.path.relpath(file_path, os.path.abspath(music_directory))
+        response = app.response_class(mimetype=mimetypes.guess_type(file_path)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + quote(relative_path.replace(os.sep, '/'))
+        return response
+
+    try:
+        response = send_file(file_path, conditional=True, etag=etag or True, last_modified=mtime,
+                             max_age=app.config['AUDIO_MAX_AGE'])
+        # tells players on the first full response that they can seek with range requests
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+    except FileNotFoundError:
+        # removed since it was cached, the watcher will drop the song
+        audio_paths.discard(key)
+        abort(404, description="File not found")
+
+
+class TranscodeCache:
+    """
+    Size-bounded LRU of transcoded files in TRANSCODE_CACHE_DIR. Files are named after the content hash
+    of their source and the bitrate, so they never go stale and survive restarts: the directory is read
+    back in when the cache is first used, oldest mtime first. Using a file bumps its mtime, and once the
+    files add up to more than max_bytes the least recently used ones are deleted.
+    """
+
+    def __init__(self, directory: str = TRANSCODE_CACHE_DIR, max_bytes: int = TRANSCODE_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._files = None  # name -> size, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._files is not None:
+            return
+        found = []
+        os.makedirs(self.directory, exist_ok=True)
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name, stat.st_size))
+        self._files = OrderedDict((name, size) for _, name, size in sorted(found))
+        self._bytes = sum(self._files.values())
+
+    def get(self, name: str):
+        # absolute path of a cached file, or None
+        with self._lock:
+            self._load()
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+        path = os.path.abspath(os.path.join(self.directory, name))
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._bytes -= self._files.pop(name, 0)
+            return None
+        return path
+
+    def add(self, name: str, size: int):
+        # records a file that was just written into the directory and evicts what doesn't fit anymore
+        evicted = []
+        with self._lock:
+            self._load()
+            self._bytes += size - self._files.get(name, 0)
+            self._files[name] = size
+            self._files.move_to_end(name)
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                old_name, old_size = self._files.popitem(last=False)
+                self._bytes -= old_size
+                evicted.append(old_name)
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old_name))
+            except FileNotFoundError:
+                pass
+
+
+transcode_cache = TranscodeCache()
+# transcodes running or waiting, by cache file name, so a song is only ever transcoded once at a time
+_transcodes = {}
+_transcodes_lock = threading.Lock()
+# the bitrate each queue's client asked for last, what the songs coming up in that queue get transcoded to
+transcode_bitrates = OrderedDict()
+# queues with a prewarm job waiting on prewarm_pool, so a burst of queue changes queues only one
+_prewarm_pending = set()
+_prewarm_lock = threading.Lock()
+
+
+def ffmpeg_path():
+    return shutil.which(app.config.get('FFMPEG', 'ffmpeg'))
+
+
+def transcode_name(file_path: str, etag, mtime, bitrate: int):
+    # cache file name for a source at a bitrate, from its content hash when it has one
+    source = etag or hashlib.sha1(f"{file_path}:{mtime}".encode()).hexdigest()
+    return f"{source}-{bitrate}k.mp3"
+
+
+def source_bitrate(key):
+    # average bitrate (kbps) of a song's file from its size and length, None if it isn't known
+    con = get_db_connection()
+    cur = con.cursor()
+    if key[0] == 'id':
+        cur.execute("SELECT size, length FROM songs WHERE id = ?", (key[1],))
+    else:
+        cur.execute("SELECT size, length FROM songs WHERE path = ?", (key[1],))
+    row = cur.fetchone()
+    cur.close()
+    con.close()
+    if not row or not row[0] or not row[1]:
+        return None
+    return row[0] * 8 / row[1] / 1000
+
+
+def start_transcode(file_path: str, name: str, bitrate: int):
+    """
+    Future for the cache path of `name`, transcoding file_path with ffmpeg on transcode_pool unless the
+    same transcode is already running. The future's result is None if ffmpeg failed.
+    """
+    with _transcodes_lock:
+        future = _transcodes.get(name)
+        if future is None:
+            future = _transcodes[name] = transcode_pool.submit(_transcode, file_path, name, bitrate)
+    return future
+
+
+def _transcode(file_path: str, name: str, bitrate: int, low_priority: bool = False):
+    try:
+        cached = transcode_cache.get(name)
+        if cached:
+            return cached
+        os.makedirs(TRANSCODE_CACHE_DIR, exist_ok=True)
+        target = os.path.abspath(os.path.join(TRANSCODE_CACHE_DIR, name))
+        temp_path = f"{target}.{threading.get_ident()}.tmp"
+        command = [ffmpeg_path(), "-nostdin", "-v", "error", "-y", "-i", file_path, "-map", "0:a:0",
+                   "-c:a", "libmp3lame", "-b:a", f"{bitrate}k", "-f", "mp3", temp_path]
+        if low_priority and shutil.which("nice"):
+            command = ["nice", "-n", "10", *command]
+        try:
+            subprocess.run(command, check=True, capture_output=True, timeout=TRANSCODE_TIMEOUT * 5)
+            os.replace(temp_path, target)
+        except (OSError, subprocess.SubprocessError) as e:
+            log_sampled(logging.WARNING, "transcode failed", "Could not transcode %s. Error: %s", file_path, e)
+            transcodes_total.inc(1, "failed")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+        transcodes_total.inc(1, "done")
+        transcode_cache.add(name, os.path.getsize(target))
+        return target
+    finally:
+        with _transcodes_lock:
+            _transcodes.pop(name, None)
+
+
+def transcoded_audio(key, bitrate: int):
+    """
+    (path, etag) of the song as an mp3 at `bitrate`, transcoding it now if it isn't cached, or None when
+    the original should be sent instead: no ffmpeg, the song's own bitrate isn't higher, or the
+    transcode failed or took longer than TRANSCODE_TIMEOUT.
+    """
+    entry = resolve_audio(key)
+    if entry is None or not ffmpeg_path():
+        return None
+    file_path, etag, mtime = entry
+    name = transcode_name(file_path, etag, mtime, bitrate)
+    cached = transcode_cache.get(name)
+    if cached:
+        transcodes_total.inc(1, "cached")
+        return cached, name
+    original = source_bitrate(key)
+    if original is not None and original <= bitrate * 1.1:
+        return None
+    try:
+        path = start_transcode(file_path, name, bitrate).result(timeout=TRANSCODE_TIMEOUT)
+    except TimeoutError:
+        return None
+    return (path, name) if path else None
+
+
+def remember_bitrate(owner, bitrate: int):
+    # stores the bitrate a queue's client asked for, returns whether it changed
+    with _prewarm_lock:
+        changed = transcode_bitrates.get(owner) != bitrate
+        transcode_bitrates[owner] = bitrate
+        transcode_bitrates.move_to_end(owner)
+        if len(transcode_bitrates) > QUEUE_OWNERS_MAX:
+            transcode_bitrates.popitem(last=False)
+    return changed
+
+
+def queue_prewarm(owner):
+    # hands a queue to prewarm_pool, unless its client never asked for a bitrate or a job is already waiting
+    with _prewarm_lock:
+        if owner not in transcode_bitrates or owner in _prewarm_pending:
+            return
+        _prewarm_pending.add(owner)
+    prewarm_pool.submit(prewarm_upcoming, owner)
+
+
+def prewarm_upcoming(owner=SHARED_QUEUE):
+    # transcodes the songs at the front of a queue to the bitrate its client last asked for
+    with _prewarm_lock:
+        _prewarm_pending.discard(owner)
+        bitrate = transcode_bitrates.get(owner)
+    if bitrate is None or not ffmpeg_path():
+        return
+    for entry_id, song_id in queues.entries(owner, limit=TRANSCODE_PREWARM):
+        entry = resolve_audio(('id', song_id))
+        if entry is None:
+            continue
+        original = source_bitrate(('id', song_id))
+        if original is not None and original <= bitrate * 1.1:
+            continue
+        name = transcode_name(entry[0], entry[1], entry[2], bitrate)
+        if transcode_cache.get(name) is None:
+            _prewarm(entry[0], name, bitrate)
+
+
+def _prewarm(file_path: str, name: str, bitrate: int):
+    # transcodes on the prewarm thread, listed in _transcodes while it runs so a request for the same
+    # song waits for it instead of starting a second ffmpeg
+    future = Future()
+    with _transcodes_lock:
+        if name in _transcodes:
+            return
+        _transcodes[name] = future
+    future.set_running_or_notify_cancel()
+    try:
+        future.set_result(_transcode(file_path, name, bitrate, low_priority=True))
+    except Exception as e:
+        future.set_exception(e)
+        raise
+
+
+def send_audio_at_bitrate(key):
+    """
+    send_audio, or with ?bitrate= (one of TRANSCODE_BITRATES, rounded down to the nearest) the song as
+    an mp3 at that bitrate, with the same range and validator support. Falls back to the original file
+    when transcoding isn't possible or wouldn't make it smaller.
+    """
+    requested = request.args.get('bitrate', type=int)
+    if requested is None:
+        return send_audio(key)
+    bitrate = max([rate for rate in TRANSCODE_BITRATES if rate <= requested] or [TRANSCODE_BITRATES[0]])
+    owner = queue_owner()
+    if remember_bitrate(owner, bitrate):
+        queue_prewarm(owner)
+    transcoded = transcoded_audio(key, bitrate)
+    if transcoded is None:
+        return send_audio(key)
+    path, etag = transcoded
+    response = send_file(path, mimetype='audio/mpeg', conditional=True, etag=etag,
+                         max_age=app.config['AUDIO_MAX_AGE'])
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+@app.route('/api/audio/<path:filename>')
+def serve_audio(filename):
+    return send_audio_at_bitrate(('file', filename))
+
+
+@app.route('/api/stream/<int:song_id>')
+def serve_audio_by_id(song_id):
+    # same as /api/audio but addressed by song id, which doesn't break when files are renamed
+    return send_audio_at_bitrate(('id', song_id))
 
 def clean_up_paths():
     con = get_db_connection()
@@ -502,56 +2783,270 @@ def clean_up_paths():
     con.commit()
     cur.close()
     con.close()
-    print("Database paths cleaned up.")
+    log.info("Database paths cleaned up.")
+
+
+def song_to_dict(song):
+    # Format a (name, artist, album, length, path, cover_art) row as a dictionary for JSON serialization
+    return {
+        "title": song[0] or "Unknown Title",
+        "artist": song[1] or "Unknown Artist",
+        "album": song[2] or "Unknown Album",
+        "length": song[3] or "Unknown Length",
+        "path": song[4],
+        "cover_art": song[5]
+    }
+
+
+class SongRecord:
+    # one song's metadata as served to the frontend, __slots__ keeps thousands of cached records small
+    __slots__ = ('id', 'name', 'artist', 'album', 'length', 'path', 'cover_art')
+
+    def __init__(self, row):
+        self.id, self.name, self.artist, self.album, self.length, self.path, self.cover_art = row
+
+    def to_dict(self):
+        song = song_to_dict((self.name, self.artist, self.album, self.length, self.path, self.cover_art))
+        song["id"] = self.id
+        return song
+
+
+class SongCache:
+    """
+    Read-through LRU of SongRecords keyed by song id, with a map from song name to id for the name based
+    endpoints. Misses are loaded with one SONG_SELECT query per call however many songs are asked for.
+    Every ingest, update and delete bumps the library version, so the cache empties itself whenever the
+    version differs from the one its records were read at, including changes made by other processes.
+    """
+
+    def __init__(self, size: int = SONG_CACHE_SIZE):
+        self.size = size
+        self._records = OrderedDict()
+        # name -> lowest song id with that name, only filled by name lookups since they see every duplicate
+        self._names = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _check_version(self, cur):
+        version = get_library_version(cur)
+        with self._lock:
+            if version != self._version:
+                self._records.clear()
+                self._names.clear()
+                self._version = version
+
+    def _cached(self, song_id):
+        record = self._records.get(song_id)
+        if record is not None:
+            self._records.move_to_end(song_id)
+        return record
+
+    def _store(self, record):
+        self._records[record.id] = record
+        self._records.move_to_end(record.id)
+        if len(self._records) > self.size:
+            evicted = self._records.popitem(last=False)[1]
+            if self._names.get(evicted.name) == evicted.id:
+                del self._names[evicted.name]
+
+    def get_many(self, song_ids):
+        # {id: SongRecord} for the ids that exist
+        song_ids = list(dict.fromkeys(song_ids))
+        con = get_db_connection()
+        cur = con.cursor()
+        self._check_version(cur)
+        found, missing = {}, []
+        with self._lock:
+            for song_id in song_ids:
+                record = self._cached(song_id)
+                if record is None:
+                    missing.append(song_id)
+                else:
+                    found[song_id] = record
+        for start in range(0, len(missing), SONG_BATCH_MAX):
+            chunk = missing[start:start + SONG_BATCH_MAX]
+            cur.execute(SONGS_BY_ID_SQL.format(placeholders(len(chunk))), chunk)
+            rows = cur.fetchall()
+            with self._lock:
+                for row in rows:
+                    found[row[0]] = record = SongRecord(row)
+                    self._store(record)
+        cur.close()
+        con.close()
+        return found
+
+    def get_many_by_name(self, names):
+        # {name: SongRecord} for the names that exist, the song with the lowest id wins for duplicate names
+        names = list(dict.fromkeys(names))
+        con = get_db_connection()
+        cur = con.cursor()
+        self._check_version(cur)
+        found, missing = {}, []
+        with self._lock:
+            for name in names:
+                record = self._cached(self._names.get(name))
+                if record is None:
+                    missing.append(name)
+                else:
+                    found[name] = record
+        for start in range(0, len(missing), SONG_BATCH_MAX):
+            chunk = missing[start:start + SONG_BATCH_MAX]
+            cur.execute(SONGS_BY_NAME_SQL.format(placeholders(len(chunk))), chunk)
+            rows = cur.fetchall()
+            with self._lock:
+                for row in rows:  # lowest id last, so it ends up in found
+                    found[row[1]] = record = SongRecord(row)
+                    self._store(record)
+                    self._names[record.name] = record.id
+        cur.close()
+        con.close()
+        return found
+
+    def get(self, song_id):
+        return self.get_many([song_id]).get(song_id)
+
+    def get_by_name(self, name):
+        return self.get_many_by_name([name]).get(name)
+
+
+song_cache = SongCache()
+
+
+def get_library_version(cur):
+    # counter bumped by triggers whenever songs, artists or albums change, used for ETags
+    cur.execute("SELECT version FROM library_meta WHERE id = 0")
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def encode_cursor(name, song_id):
+    # opaque keyset cursor for /api/all_songs pages
+    return base64.urlsafe_b64encode(json.dumps([name, song_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        name, song_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(name), int(song_id)
+    except (ValueError, TypeError):
+        return None
 
 
 @app.route('/api/all_songs',
            methods=['GET'])
 def get_all_songs():
+    """
+    Without parameters the whole library is streamed as a JSON array ordered by song name, which keeps
+    memory flat no matter how big the library is. With ?limit=N it returns one page as
+    {"songs": [...], "next": cursor} and ?after=<next> gets the following page; pages are keyset based
+    so every page costs the same. Responses carry an ETag tied to the library version, so clients
+    revalidating an unchanged library get a 304 without any query beyond the version lookup. For
+    logged in users every song has a "favorite" flag and the ETag also covers their favorites.
+    """
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after')
+    favorites = request_favorites()
+
     con = get_db_connection()
     cur = con.cursor()
-    cur.execute('''SELECT songs.name, artists.name AS artist, albums.name AS album, 
-                          songs.length, songs.path, songs.cover_art 
-                   FROM songs
-                   LEFT JOIN artists ON songs.artist_id = artists.id
-                   LEFT JOIN albums ON songs.album_id = albums.id
-                   ORDER BY songs.name ASC''')
-    get_all_songs = cur.fetchall()
-    cur.close()
-    con.close()
+    etag = f"lib-{get_library_version(cur)}-{limit}-{after}"
+    if favorites is not None:
+        etag += f"-fav-{favorites[1]}"
+    if request.if_none_match.contains(etag):
+        cur.close()
+        con.close()
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    if limit is not None:
+        limit = min(max(limit, 1), ALL_SONGS_MAX_LIMIT)
+        position = decode_cursor(after) if after else None
+        if after and position is None:
+            cur.close()
+            con.close()
+            return jsonify({"error": "Invalid cursor"}), 400
+        cur.execute(ALL_SONGS_PAGE_SQL, (*(position or ("", 0)), limit))
+        page = cur.fetchall()
+        cur.close()
+        con.close()
+        next_cursor = encode_cursor(page[-1][0], page[-1][6]) if len(page) == limit else None
+        songs = [{**song_to_dict(song), "id": song[6]} for song in page]
+        if favorites is not None:
+            for song, row in zip(songs, page):
+                song["favorite"] = row[6] in favorites[0]
+        response = jsonify({"songs": songs, "next": next_cursor})
+    else:
+        cur.execute("SELECT 1 FROM songs LIMIT 1")
+        empty = cur.fetchone() is None
+        cur.close()
+        con.close()
+        if empty:
+            return jsonify({"message": "No songs in library!"}), 404
+        response = app.response_class(stream_with_context(_stream_all_songs(favorites)), mimetype='application/json')
 
-    # (N) Format the result as a list of dictionaries for JSON serialization
-    if get_all_songs:
-        songs = []
-        for song in get_all_songs:
-            song_obj = {
-                "title": song[0] or "Unknown Title",
-                "artist": song[1] or "Unknown Artist",
-                "album": song[2] or "Unknown Album",
-                "length": song[3] or "Unknown Length",
-                "path": song[4],
-                "cover_art": song[5]
-            }
-            songs.append(song_obj)
+    # clients may keep the response but have to revalidate it, which is where the 304s come from
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-        return jsonify(songs), 200
-    else:
-        return jsonify({"message": "No songs in library!"}), 404
+
+def _stream_all_songs(favorites=None):
+    # yields the whole library as one JSON array, a batch of rows at a time, with favorite flags when given favorites
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        cur.execute('''SELECT songs.name, artists.name AS artist, albums.name AS album, 
+                              songs.length, songs.path, songs.cover_art, songs.id
+                       FROM songs
+                       LEFT JOIN artists ON songs.artist_id = artists.id
+                       LEFT JOIN albums ON songs.album_id = albums.id
+                       ORDER BY songs.name ASC''')
+        separator = '['
+        while True:
+            rows = cur.fetchmany(ALL_SONGS_STREAM_BATCH)
+            if not rows:
+                break
+            songs = [{**song_to_dict(song), "id": song[6]} for song in rows]
+            if favorites is not None:
+                for song in songs:
+                    song["favorite"] = song["id"] in favorites[0]
+            yield separator + ','.join(json.dumps(song) for song in songs)
+            separator = ','
+        yield ']' if separator == ',' else '[]'
+    finally:
+        cur.close()
+        con.close()
 
 
 @app.route('/api/cover_art/<path:filename>')
 def serve_cover_art(filename):
+    """
+    Serves cover art, optionally resized with ?size= (one of ART_SIZES). Art stored under its content
+    hash never changes, so those responses are marked immutable and cached by clients for a year. If a
+    variant isn't made yet the original is sent and the variant is queued.
+    """
     # (Ja) define the base directory for cover art dynamically
     base_cover_art_folder = os.path.abspath("cover_art")
     # (Ja) construct the full path to the requested cover art
-    file_path = os.path.join(base_cover_art_folder, filename)
-    # (Ja) log the requested file path for debugging
-    print(f"Requested cover art path - {file_path}")
+    file_path = safe_join(base_cover_art_folder, filename)
     # (Ja) check if the file exists
-    if not os.path.isfile(file_path):
-        print(f"Cover art not found: {file_path}")
+    if file_path is None or not os.path.isfile(file_path):
         abort(404, description="Cover art not found")
+
+    size = request.args.get('size', type=int)
+    if size in ART_SIZES:
+        variant_path = art_variant_path(file_path, size)
+        if os.path.isfile(variant_path):
+            file_path = variant_path
+        else:
+            queue_art_variants([file_path])
+
     # (Ja) serve the cover art file
+    if CONTENT_HASH_NAME.fullmatch(os.path.splitext(filename)[0]):
+        response = send_file(file_path, max_age=ART_MAX_AGE)
+        response.headers['Cache-Control'] = f'public, max-age={ART_MAX_AGE}, immutable'
+        return response
     return send_file(file_path)
 
 
@@ -565,49 +3060,254 @@ def upload_file():
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
 
-    file.save(os.path.join("Music", file.filename))
-    add_Dir()
-    return jsonify({"message": f"File {file.filename} has been uploaded successfully"}), 200
+    filename = secure_filename(file.filename)
+    file_path = music_directory + '/' + filename
+    file.save(file_path)
+    # only the uploaded file is indexed, the library watcher picks up anything else copied into Music
+    sync_files([file_path])
+    return jsonify({"message": f"File {filename} has been uploaded successfully"}), 200
+
+
+class TTLCache:
+    # bounded LRU whose entries are forgotten AUTH_CACHE_TTL seconds after they were stored
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, size: int = AUTH_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# token -> (user id, expiry) and user id -> profile, so authenticated requests usually skip both the
+# signature check and the users query. Anything that changes a user's profile has to discard it here
+decoded_tokens = TTLCache()
+user_profiles = TTLCache()
+
+
+def decode_token(token: str):
+    """
+    Returns the user id of a token, decoding it only when it isn't cached. Raises the same jwt errors as
+    jwt.decode; a cached token is dropped as soon as it expires, so expired tokens still get decoded and rejected.
+    """
+    cached = decoded_tokens.get(token)
+    if cached is not None and (cached[1] is None or cached[1] > time.time()):
+        return cached[0]
+    data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+    user_id = data['user_id']
+    decoded_tokens.put(token, (user_id, data.get('exp')))
+    return user_id
+
+
+def load_user_profile(user_id):
+    # the user's profile as a new dictionary (callers may change it), or None if there is no such user
+    profile = user_profiles.get(user_id)
+    if profile is None:
+        con = get_db_connection()
+        cur = con.cursor()
+        # (Ja) retrieve full user information
+        cur.execute("""
+            SELECT username, name, description, profile_image
+            FROM users WHERE id = ?
+        """, (user_id,))
+        user = cur.fetchone()
+        cur.close()
+        con.close()
+        if not user:
+            return None
+        profile = {
+            'id': user_id,
+            'username': user[0],
+            'name': user[1],
+            'description': user[2],
+            'profile_image': user[3]
+        }
+        user_profiles.put(user_id, profile)
+    return dict(profile)
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """
+    Bounded pool for generate_password_hash and check_password_hash. run() blocks the calling request
+    until its hash is done, but at most `workers` hashes use the CPU at once and at most `backlog` wait,
+    beyond that run() raises PasswordHasherBusy right away instead of queueing. stats() reports the queue
+    depth and how long hashes waited and ran.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, backlog: int = PASSWORD_HASH_BACKLOG):
+        self.workers = workers
+        self.backlog = backlog
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._counts = {'completed': 0, 'rejected': 0, 'wait_seconds': 0.0, 'hash_seconds': 0.0, 'max_depth': 0}
+
+    def run(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.workers + self.backlog:
+                self._counts['rejected'] += 1
+                raise PasswordHasherBusy()
+            self._pending += 1
+            self._counts['max_depth'] = max(self._counts['max_depth'], self._pending)
+        try:
+            future = self._executor.submit(self._timed, time.perf_counter(), fn, args)
+        except Exception:
+            # never reaches _timed, which would give the slot back
+            with self._lock:
+                self._pending -= 1
+            raise
+        return future.result()
+
+    def _timed(self, queued, fn, args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            finished = time.perf_counter()
+            with self._lock:
+                self._pending -= 1
+                self._counts['completed'] += 1
+                self._counts['wait_seconds'] += started - queued
+                self._counts['hash_seconds'] += finished - started
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'backlog': self.backlog, 'depth': self._pending, **self._counts}
+
+
+class RateLimiter:
+    """
+    Token bucket per client: `limit` attempts, refilled evenly over `period` seconds. Remembers the
+    most recently seen `clients` keys, a client that was forgotten simply starts with a full bucket.
+    """
+
+    def __init__(self, limit: int = AUTH_RATE_LIMIT, period: float = AUTH_RATE_PERIOD,
+                 clients: int = AUTH_RATE_CLIENTS):
+        self.limit = limit
+        self.rate = limit / period
+        self.clients = clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def acquire(self, key):
+        # None if the attempt is allowed, otherwise the seconds until it would be
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.limit, now))
+            tokens = min(self.limit, tokens + (now - updated) * self.rate)
+            wait = None
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.limited += 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+password_hasher = PasswordHasher()
+auth_attempts = RateLimiter()
+
+
+def auth_rate_limited(f):
+    # answers 429 to clients over AUTH_RATE_LIMIT and 503 when the password hasher is full
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        wait = auth_attempts.acquire(request.remote_addr)
+        if wait is not None:
+            response = jsonify({"error": "Too many attempts, try again later"})
+            response.headers['Retry-After'] = str(int(wait) + 1)
+            return response, 429
+        try:
+            return f(*args, **kwargs)
+        except PasswordHasherBusy:
+            response = jsonify({"error": "Server is busy, try again shortly"})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+
+    return decorated
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # metrics of this process in the Prometheus text format
+    hasher = password_hasher.stats()
+    queue_stats = queues.stats()
+    gauges = [
+        ("password_hash_queue_depth", "Password hashes running or waiting", hasher['depth']),
+        ("password_hash_rejected_total", "Logins and registrations turned away because the hasher was full",
+         hasher['rejected']),
+        ("password_hashes_total", "Password hashes done", hasher['completed']),
+        ("password_hash_wait_seconds_total", "Time password hashes waited for a worker", hasher['wait_seconds']),
+        ("password_hash_seconds_total", "Time spent hashing passwords", hasher['hash_seconds']),
+        ("auth_rate_limited_total", "Login and register attempts answered with 429", auth_attempts.limited),
+        ("song_cache_records", "Song records in the metadata cache", len(song_cache._records)),
+        ("event_history_size", "Queue events kept for reconnecting /api/events clients", queue_stats['event_history']),
+        ("queues_in_memory", "Play queues held in memory", queue_stats['queues']),
+        ("queue_unwritten_changes", "Queue entries changed since the last write to the database", queue_stats['unwritten']),
+    ]
+    return app.response_class(render_metrics(gauges), mimetype='text/plain; version=0.0.4')
+
+
+def get_bearer_token():
+    # (Ja) JWT is expected in the authorization header
+    if 'Authorization' in request.headers:
+        parts = request.headers['Authorization'].split()
+        # (Ja) token should follow "Bearer <token>" format
+        if len(parts) == 2 and parts[0] == 'Bearer':
+            return parts[1]
+    return None
+
+
+def request_user_id():
+    # id of the user whose valid token came with the request, or None. For endpoints where logging in is optional
+    return token_user_id(get_bearer_token())
 
 
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-
-        # (Ja) JWT is expected in the authorization header
-        if 'Authorization' in request.headers:
-            parts = request.headers['Authorization'].split()
-            # (Ja) token should follow "Bearer <token>" format
-            if len(parts) == 2 and parts[0] == 'Bearer':
-                token = parts[1]
+        token = get_bearer_token()
 
         # (Ja) return error if token is missing
         if not token:
             return jsonify({'error': 'Token is missing!'}), 401
 
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            user_id = data['user_id']
-            con = get_db_connection()
-            cur = con.cursor()
-            # (Ja) retrieve full user information
-            cur.execute("""
-                SELECT username, name, description, profile_image
-                FROM users WHERE id = ?
-            """, (user_id,))
-            user = cur.fetchone()
-            cur.close()
-            con.close()
-            if not user:
+            current_user = load_user_profile(decode_token(token))
+            if not current_user:
                 return jsonify({'error': 'User not found!'}), 401
-            current_user = {
-                'id': user_id,
-                'username': user[0],
-                'name': user[1],
-                'description': user[2],
-                'profile_image': user[3]
-            }
         except jwt.ExpiredSignatureError:
             # (Ja) return error if token has expired
             return jsonify({'error': 'Token has expired!'}), 401
@@ -621,6 +3321,7 @@ def token_required(f):
     return decorated
 
 @app.route('/api/register', methods=['POST'])
+@auth_rate_limited
 def register():
     data = request.get_json()
 
@@ -636,10 +3337,10 @@ def register():
     profile_image = data.get('profile_image', '')
 
     # (Ja) hash the password
-    password_hash = generate_password_hash(password)
+    password_hash = password_hasher.run(generate_password_hash, password)
 
+    con = get_db_connection()
     try:
-        con = get_db_connection()
         cur = con.cursor()
         # (Ja) insert new user into the database, updated fields
         cur.execute("""
@@ -657,6 +3358,7 @@ def register():
 
 
 @app.route('/api/login', methods=['POST'])
+@auth_rate_limited
 def login():
     data = request.get_json()
 
@@ -670,16 +3372,13 @@ def login():
     con = get_db_connection()
     cur = con.cursor()
     # (Ja) retrieve password hash for the provided username
-    cur.execute("""
-        SELECT id, password_hash, name, description, profile_image
-        FROM users WHERE username = ?
-    """, (username,))
+    cur.execute(USER_BY_NAME_SQL, (username,))
     user = cur.fetchone()
     cur.close()
     con.close()
 
     # (Ja) check if password matches hash in database
-    if user and check_password_hash(user[1], password):
+    if user and password_hasher.run(check_password_hash, user[1], password):
         # (Ja) generate JWT token valid for 24 hours, update fields
         token = jwt.encode({
             'user_id': user[0],
@@ -738,6 +3437,7 @@ def upload_profile_image(current_user):
         con.commit()
         cur.close()
         con.close()
+        user_profiles.discard(current_user['id'])
 
         return jsonify({"message": "Profile image uploaded successfully", "profile_image": file_path}), 200
     else:
@@ -779,6 +3479,7 @@ def update_user_profile(current_user):
     con.commit()
     cur.close()
     con.close()
+    user_profiles.discard(current_user['id'])
 
     current_user['name'] = name
     current_user['description'] = description
@@ -809,84 +3510,480 @@ def add_new_user_columns():
 
     con.commit()
     cur.close()
-    
-@app.route('/api/favorites', methods=['GET'])
-@token_required
-def get_favorites(current_user):
+    con.close()
+
+
+def add_fingerprint_columns():
+    # adds the file fingerprint columns to song tables made before rescans existed
     con = get_db_connection()
     cur = con.cursor()
+    for column in ("size INTEGER", "mtime REAL", "hash TEXT"):
+        try:
+            cur.execute(f"ALTER TABLE songs ADD COLUMN {column};")
+        except sql.OperationalError:
+            pass  # column already exists
+    cur.execute("CREATE INDEX IF NOT EXISTS songs_path ON songs(path);")
+    con.commit()
+    cur.close()
+    con.close()
 
-    # (Ja) get favorite songs for the current user
-    cur.execute('''
-        SELECT songs.id, songs.name, artists.name AS artist, albums.name AS album, 
-               songs.length, songs.path, songs.cover_art 
-        FROM favorites
-        JOIN songs ON favorites.song_id = songs.id
-        LEFT JOIN artists ON songs.artist_id = artists.id
-        LEFT JOIN albums ON songs.album_id = albums.id
-        WHERE favorites.user_id = ?
-        ORDER BY songs.name ASC
-    ''', (current_user['id'],))
-    favorites = cur.fetchall()
+
+
+def add_search_index():
+    # creates the search index on databases made before it existed and fills it from the songs table
+    con = get_db_connection()
+    cur = con.cursor()
+    cur.executescript(SEARCH_INDEX_SQL)
+    cur.execute("SELECT (SELECT COUNT(*) FROM songs_fts) = (SELECT COUNT(*) FROM songs)")
+    if not cur.fetchone()[0]:
+        cur.execute("DELETE FROM songs_fts")
+        cur.execute('''INSERT INTO songs_fts(rowid, name, artist, album)
+                       SELECT songs.id, songs.name, artists.name, albums.name
+                       FROM songs
+                       LEFT JOIN artists ON songs.artist_id = artists.id
+                       LEFT JOIN albums ON songs.album_id = albums.id''')
+    con.commit()
     cur.close()
     con.close()
 
-    if favorites:
-        songs = []
-        for song in favorites:
-            song_obj = {
-                "id": song[0],
-                "title": song[1] or "Unknown Title",
-                "artist": song[2] or "Unknown Artist",
-                "album": song[3] or "Unknown Album",
-                "length": song[4] or "Unknown Length",
-                "path": song[5],
-                "cover_art": song[6]
-            }
-            songs.append(song_obj)
 
+def migrate_queue_ordering():
+    # rebuilds a queue table that still uses dense positions into the sort_key layout, keeping its order
+    con = get_db_connection()
+    cur = con.cursor()
+    cur.execute("PRAGMA table_info(queue)")
+    columns = [row[1] for row in cur.fetchall()]
+    if 'position' in columns:
+        cur.executescript('''
+            BEGIN;
+            ALTER TABLE queue RENAME TO queue_old;
+            CREATE TABLE queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sort_key REAL NOT NULL,
+                song_id INTEGER,
+                FOREIGN KEY (song_id) REFERENCES songs(id) ON DELETE CASCADE
+            );
+            INSERT INTO queue (id, sort_key, song_id) SELECT id, position, song_id FROM queue_old;
+            DROP TABLE queue_old;
+            CREATE INDEX IF NOT EXISTS queue_sort_key ON queue(sort_key);
+            COMMIT;
+        ''')
+    cur.close()
+    con.close()
+
+
+def add_library_version():
+    # creates the library version counter and its triggers on databases made before it existed
+    con = get_db_connection()
+    cur = con.cursor()
+    cur.executescript(LIBRARY_VERSION_SQL)
+    con.commit()
+    cur.close()
+    con.close()
+
+
+def add_lookup_indexes():
+    # secondary indexes for the columns the endpoints filter and join on
+    con = get_db_connection()
+    cur = con.cursor()
+    cur.executescript('''
+        CREATE INDEX IF NOT EXISTS songs_album ON songs(album_id, path);
+        CREATE INDEX IF NOT EXISTS songs_artist ON songs(artist_id);
+        CREATE INDEX IF NOT EXISTS queue_song ON queue(song_id);
+        CREATE INDEX IF NOT EXISTS favorites_song ON favorites(song_id);
+    ''')
+    con.commit()
+    cur.close()
+    con.close()
+
+
+def add_queue_owners():
+    # gives every queue entry the user and device it belongs to, existing entries make up the shared queue
+    con = get_db_connection()
+    cur = con.cursor()
+    cur.execute("PRAGMA table_info(queue)")
+    columns = [row[1] for row in cur.fetchall()]
+    if 'user_id' not in columns:
+        cur.execute("ALTER TABLE queue ADD COLUMN user_id INTEGER NOT NULL DEFAULT 0")
+        cur.execute("ALTER TABLE queue ADD COLUMN device TEXT NOT NULL DEFAULT 'default'")
+    cur.execute("CREATE INDEX IF NOT EXISTS queue_owner ON queue(user_id, device, sort_key)")
+    con.commit()
+    cur.close()
+    con.close()
+
+
+def add_skipped_files():
+    # creates the table of files skipped as duplicate songs on databases made before it existed
+    con = get_db_connection()
+    cur = con.cursor()
+    cur.executescript(SKIPPED_FILES_SQL)
+    con.commit()
+    cur.close()
+    con.close()
+
+
+def add_song_name_index():
+    # index for looking songs up by name and for the name ordered pages of /api/all_songs
+    con = get_db_connection()
+    cur = con.cursor()
+    cur.execute("CREATE INDEX IF NOT EXISTS songs_name ON songs(name)")
+    con.commit()
+    cur.close()
+    con.close()
+
+
+def add_queue_versions():
+    # the stamp of the last write to each queue, lets processes sharing the database see each other's changes
+    con = get_db_connection()
+    cur = con.cursor()
+    cur.executescript('''CREATE TABLE IF NOT EXISTS queue_versions (
+                               user_id INTEGER NOT NULL,
+                               device TEXT NOT NULL,
+                               version INTEGER NOT NULL,
+                               PRIMARY KEY (user_id, device)
+                           );
+                           CREATE INDEX IF NOT EXISTS queue_versions_version ON queue_versions(version);''')
+    con.commit()
+    cur.close()
+    con.close()
+
+
+'''
+Schema migrations in the order they have to run. schema_version remembers the last one a database has
+applied, so migrate() only runs the newer ones. The first six are the setup functions that used to run
+on every start; they are safe to run on databases that already have their changes, which is what
+happens once on databases made before schema_version existed. New schema changes get a new entry at
+the end, never add them to one that was released: databases that already ran it would never see them.
+clear_table() drops schema_version along with the library tables, so every migration runs again.
+'''
+MIGRATIONS = (
+    # runs before create_table because create_table indexes queue.sort_key, which older queue tables don't have
+    (1, "queue ordered by sort_key", migrate_queue_ordering),
+    (2, "base tables", create_table),
+    (3, "user profile columns", add_new_user_columns),
+    (4, "file fingerprints", add_fingerprint_columns),
+    (5, "search index", add_search_index),
+    (6, "library version", add_library_version),
+    (7, "lookup indexes", add_lookup_indexes),
+    (8, "queues per user and device", add_queue_owners),
+    (9, "skipped file fingerprints", add_skipped_files),
+    (10, "song name index", add_song_name_index),
+    (11, "queue versions", add_queue_versions),
+)
+
+
+def get_schema_version(cur):
+    cur.execute("SELECT MAX(version) FROM schema_version")
+    return cur.fetchone()[0] or 0
+
+
+def migrate():
+    # brings the database up to the newest schema, returns the versions that were applied
+    con = get_db_connection()
+    cur = con.cursor()
+    cur.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+                       version INTEGER PRIMARY KEY,
+                       description TEXT,
+                       applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                   )''')
+    con.commit()
+    current = get_schema_version(cur)
+    applied = []
+    for version, description, apply in MIGRATIONS:
+        if version <= current:
+            continue
+        log.info("Applying migration %d: %s", version, description)
+        apply()
+        cur.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+        con.commit()
+        applied.append(version)
+    cur.close()
+    con.close()
+    return applied
+
+
+'''
+the hot statements from the top of the file with sample parameters. check_query_plans() runs EXPLAIN
+QUERY PLAN on each of them, any of them scanning a table or a whole index means an index is missing.
+Queries marked True may walk an index in order because they stop after the first rows.
+'''
+HOT_QUERIES = {
+    "songs by name": (SONGS_BY_NAME_SQL.format(placeholders(2)), ("", ""), False),
+    "songs by id": (SONGS_BY_ID_SQL.format(placeholders(2)), (1, 2), False),
+    "song by path": (SONG_BY_PATH_SQL, ("",), False),
+    "album songs": (ALBUM_SONGS_SQL, (0, QUEUE_BULK_MAX), False),
+    "artist songs": (ARTIST_SONGS_SQL, (0, QUEUE_BULK_MAX), False),
+    "queue of a device": (QUEUE_OF_DEVICE_SQL, SHARED_QUEUE, False),
+    "queue entries of a song": (DELETE_SONG_QUEUE_SQL, (0,), False),
+    "queue version": (QUEUE_VERSION_SQL, SHARED_QUEUE, False),
+    "favorites of a user": (FAVORITES_OF_USER_SQL, (0,), False),
+    "favorites of a song": (DELETE_SONG_FAVORITES_SQL, (0,), False),
+    "user by name": (USER_BY_NAME_SQL, ("",), False),
+    "all songs page": (ALL_SONGS_PAGE_SQL, ("", 0, 50), True),
+}
+
+
+def check_query_plans():
+    """
+    Returns {name: plan} for the HOT_QUERIES that read a whole table or index instead of searching an
+    index, so an empty dictionary means every hot query is indexed. Scans of the search index don't count.
+    """
+    con = get_db_connection()
+    cur = con.cursor()
+    full_scans = {}
+    for name, (query, params, ordered) in HOT_QUERIES.items():
+        cur.execute(f"EXPLAIN QUERY PLAN {query}", params)
+        plan = [row[3] for row in cur.fetchall()]
+        if any(step.startswith("SCAN ") and "VIRTUAL TABLE" not in step and not (ordered and " USING " in step)
+               for step in plan):
+            full_scans[name] = plan
+    cur.close()
+    con.close()
+    return full_scans
+
+
+def check_schema():
+    """
+    Builds a new database from MIGRATIONS in a temporary directory and asserts that check_query_plans()
+    finds nothing there, so a migration that drops or forgets an index fails instead of only logging a
+    warning. `python music_database.py check` runs it and exits with an error if it fails.
+    """
+    global db_path
+    saved_path = db_path
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "check.db")
+        try:
+            migrate()
+            full_scans = check_query_plans()
+        finally:
+            with _pools_lock:
+                pool = _pools.pop(db_path, None)
+            if pool is not None:
+                pool.close_all()
+            db_path = saved_path
+    assert full_scans == {}, f"hot queries that scan a whole table: {full_scans}"
+
+
+def build_search_query(text: str):
+    """
+    Turns what the user typed into an FTS5 query. Every word becomes a quoted prefix term, so "nig vis"
+    finds "Nightvision" while typing and FTS syntax characters in the input can't break the query.
+    Returns None if there is nothing to search for.
+    """
+    terms = re.findall(r'\w+', text)
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+class FavoriteSets:
+    """
+    Every user's favorite song ids as a frozenset, read from the favorites table the first time they are
+    needed and then kept in step by change(), so listings can flag favorites with a set lookup instead of
+    joining the table on every request. Bounded LRU of FAVORITES_CACHE_USERS users. Each set comes with
+    a signature that changes whenever the set does, for ETags of responses that include the flags.
+    Writes made by other processes aren't seen until the entry is dropped, like the other caches.
+    """
+
+    def __init__(self, size: int = FAVORITES_CACHE_USERS):
+        self.size = size
+        self._sets = OrderedDict()
+        self._lock = threading.Lock()
+        # change() reads, writes and updates a set as one step, so two toggles can't undo each other
+        self._write_lock = threading.Lock()
+
+    @staticmethod
+    def _signature(favorites):
+        # count plus an order-independent mix of the ids
+        mix = 0
+        for song_id in favorites:
+            mix ^= (song_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        return f"{len(favorites)}.{mix:x}"
+
+    def _store(self, user_id, favorites):
+        entry = (favorites, self._signature(favorites))
+        with self._lock:
+            self._sets[user_id] = entry
+            self._sets.move_to_end(user_id)
+            if len(self._sets) > self.size:
+                self._sets.popitem(last=False)
+        return entry
+
+    def get(self, user_id):
+        # (frozenset of song ids, signature) of a user's favorites
+        with self._lock:
+            entry = self._sets.get(user_id)
+            if entry is not None:
+                self._sets.move_to_end(user_id)
+                return entry
+        con = get_db_connection()
+        cur = con.cursor()
+        cur.execute(FAVORITES_OF_USER_SQL, (user_id,))
+        favorites = frozenset(row[0] for row in cur.fetchall())
+        cur.close()
+        con.close()
+        return self._store(user_id, favorites)
+
+    def change(self, user_id, add=(), remove=(), toggle=()):
+        """
+        Adds, removes and toggles favorites of a user in one transaction. Songs that don't exist are
+        skipped. Returns {song_id: favorite or not} for every song that was asked about and exists.
+        """
+        song_ids.refresh()
+        with self._write_lock:
+            favorites, _ = self.get(user_id)
+            asked = [song_id for song_id in dict.fromkeys([*add, *remove, *toggle]) if song_id in song_ids]
+            add, remove, toggle = set(add), set(remove), set(toggle)
+            added = {song_id for song_id in asked if song_id in add or (song_id in toggle and song_id not in favorites)}
+            removed = {song_id for song_id in asked if song_id not in added and (song_id in remove or song_id in toggle)}
+            con = get_db_connection()
+            cur = con.cursor()
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+                cur.executemany("INSERT OR IGNORE INTO favorites (user_id, song_id) VALUES (?, ?)",
+                                [(user_id, song_id) for song_id in added])
+                cur.executemany("DELETE FROM favorites WHERE user_id = ? AND song_id = ?",
+                                [(user_id, song_id) for song_id in removed])
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
+            finally:
+                cur.close()
+                con.close()
+            favorites = (favorites | added) - removed
+            self._store(user_id, favorites)
+        return {song_id: song_id in favorites for song_id in asked}
+
+    def clear(self):
+        with self._lock:
+            self._sets.clear()
+
+
+favorite_sets = FavoriteSets()
+
+
+def request_favorites():
+    # (favorite song ids, signature) of the logged in user making the request, or None without a valid token
+    user_id = request_user_id()
+    return favorite_sets.get(user_id) if user_id is not None else None
+
+
+def flag_favorites(songs, favorites):
+    # adds "favorite": true/false to song dictionaries for logged in users, favorites as from request_favorites()
+    if favorites is not None:
+        for song in songs:
+            if song is not None:
+                song["favorite"] = song["id"] in favorites[0]
+    return songs
+
+
+def favorite_request_ids(data):
+    # song ids a favorites write is about: {"song_id": n}, {"song_name": "..."} or {"ids": [...]}, None if invalid
+    if is_integer(data.get('song_id')):
+        return [data['song_id']]
+    if isinstance(data.get('song_name'), str):
+        song = song_cache.get_by_name(data['song_name'])
+        return [song.id] if song else []
+    requested = data.get('ids')
+    if isinstance(requested, list) and 0 < len(requested) <= FAVORITES_BULK_MAX \
+            and all(map(is_integer, requested)):
+        return requested
+    return None
+
+
+@app.route('/api/favorites', methods=['POST', 'DELETE'])
+@token_required
+def change_favorites(current_user):
+    """
+    POST adds songs to the user's favorites, DELETE removes them. The body names one song with
+    {"song_id": n} or {"song_name": "..."}, or up to FAVORITES_BULK_MAX with {"ids": [...]}, which are
+    written in one transaction. Answers {"favorites": {song_id: true/false}} for the songs that exist.
+    """
+    requested = favorite_request_ids(request.get_json(silent=True) or {})
+    if requested is None:
+        return jsonify({"error": f"'song_id', 'song_name' or 'ids' (at most {FAVORITES_BULK_MAX}) is required"}), 400
+    try:
+        if request.method == 'POST':
+            changed = favorite_sets.change(current_user['id'], add=requested)
+        else:
+            changed = favorite_sets.change(current_user['id'], remove=requested)
+    except sql.Error as e:
+        return jsonify({"error": f"An error occurred: {e}"}), 500
+    if not changed:
+        return jsonify({"error": "Song not found"}), 404
+    return jsonify({"favorites": changed}), 200
+
+
+@app.route('/api/favorites/toggle', methods=['POST'])
+@token_required
+def toggle_favorites(current_user):
+    # flips whether each song is a favorite, takes the same body as POST /api/favorites and answers the same way
+    requested = favorite_request_ids(request.get_json(silent=True) or {})
+    if requested is None:
+        return jsonify({"error": f"'song_id', 'song_name' or 'ids' (at most {FAVORITES_BULK_MAX}) is required"}), 400
+    try:
+        changed = favorite_sets.change(current_user['id'], toggle=requested)
+    except sql.Error as e:
+        return jsonify({"error": f"An error occurred: {e}"}), 500
+    if not changed:
+        return jsonify({"error": "Song not found"}), 404
+    return jsonify({"favorites": changed}), 200
+
+
+@app.route('/api/favorites', methods=['GET'])
+@token_required
+def get_favorites(current_user):
+    # (Ja) get favorite songs for the current user
+    # ordered by name, the ids come from the favorites cache
+    favorite_ids, _ = favorite_sets.get(current_user['id'])
+    favorites = sorted(song_cache.get_many(favorite_ids).values(), key=lambda song: (song.name, song.id))
+
+    if favorites:
+        songs = [song.to_dict() for song in favorites]
         return jsonify(songs), 200
     else:
         return jsonify({"message": "No favorite songs"}), 200
 
+
 # (Ja) endpoint for searching songs
 @app.route('/api/search', methods=['GET'])
 def search_songs():
     query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', SEARCH_DEFAULT_LIMIT, type=int), 1), SEARCH_MAX_LIMIT)
+    offset = max(request.args.get('offset', 0, type=int), 0)
 
     con = get_db_connection()
     cur = con.cursor()
 
     # (Ja) search in songs.name, artists.name, albums.name
-    search_query = f"%{query}%"
-    cur.execute('''
-        SELECT songs.id, songs.name, artists.name AS artist, albums.name AS album, 
-               songs.length, songs.path, songs.cover_art 
-        FROM songs
-        LEFT JOIN artists ON songs.artist_id = artists.id
-        LEFT JOIN albums ON songs.album_id = albums.id
-        WHERE songs.name LIKE ? OR artists.name LIKE ? OR albums.name LIKE ?
-        ORDER BY songs.name ASC
-    ''', (search_query, search_query, search_query))
-    results = cur.fetchall()
+    # the full-text index matches every word as a prefix and ranks titles above artists above albums
+    search_query = build_search_query(query)
+    if search_query:
+        cur.execute('''
+            SELECT songs_fts.rowid
+            FROM songs_fts
+            WHERE songs_fts MATCH ?
+            ORDER BY bm25(songs_fts, 10.0, 4.0, 2.0)
+            LIMIT ? OFFSET ?
+        ''', (search_query, limit, offset))
+    else:
+        # nothing to match on, page through the whole library like before
+        cur.execute('''
+            SELECT id
+            FROM songs
+            ORDER BY name ASC
+            LIMIT ? OFFSET ?
+        ''', (limit, offset))
+    result_ids = [row[0] for row in cur.fetchall()]
     cur.close()
     con.close()
+    # only the ranking runs in SQL, the rows themselves come from the song cache
+    results = song_cache.get_many(result_ids)
 
     if results:
-        songs = []
-        for song in results:
-            song_obj = {
-                "id": song[0],
-                "title": song[1] or "Unknown Title",
-                "artist": song[2] or "Unknown Artist",
-                "album": song[3] or "Unknown Album",
-                "length": song[4] or "Unknown Length",
-                "path": song[5],
-                "cover_art": song[6]
-            }
-            songs.append(song_obj)
-
-        return jsonify(songs), 200
+        songs = [results[song_id].to_dict() for song_id in result_ids if song_id in results]
+        return jsonify(flag_favorites(songs, request_favorites())), 200
     else:
         return jsonify({"message": "No matching songs found"}), 200
 
@@ -894,73 +3991,61 @@ def search_songs():
 @app.route('/api/queue/move', methods=['PUT'])
 def move_song_in_queue():
     data = request.get_json()
+    entry_id = data.get('entry_id')
     from_position = data.get('from_position')
     to_position = data.get('to_position')
 
-    if from_position is None or to_position is None:
-        return jsonify({"error": "Both 'from_position' and 'to_position' are required"}), 400
-
-    con = get_db_connection()
-    cur = con.cursor()
-
-    # (Ja) check if the positions are valid
-    cur.execute("SELECT song_id FROM queue WHERE position = ?", (from_position,))
-    row = cur.fetchone()
-    if not row:
-        cur.close()
-        con.close()
-        return jsonify({"error": f"No song found at position {from_position}"}), 404
-
-    song_id = row[0]
-
-    # (Ja) begin a transaction
-    con.execute("BEGIN")
+    if (from_position is None and entry_id is None) or to_position is None:
+        return jsonify({"error": "'to_position' and either 'entry_id' or 'from_position' are required"}), 400
+    if not all(value is None or is_integer(value) for value in (to_position, entry_id, from_position)):
+        return jsonify({"error": "'to_position', 'entry_id' and 'from_position' must be integers"}), 400
 
     try:
-        # (Ja) if moving down the queue (to higher position number)
-        if from_position < to_position:
-            # (Ja) decrease the positions of songs between from_position +1 and to_position inclusive
-            cur.execute("""
-                UPDATE queue
-                SET position = position -1
-                WHERE position > ? AND position <= ?
-            """, (from_position, to_position))
-        elif from_position > to_position:
-            # (Ja) increase the positions of songs between to_position and from_position -1 inclusive
-            cur.execute("""
-                UPDATE queue
-                SET position = position +1
-                WHERE position >= ? AND position < ?
-            """, (to_position, from_position))
-        else:
-            # (Ja) from_position == to_position, nothing to do
-            return jsonify({"message": "Song is already at the desired position"}), 200
-
-        # (Ja) update the position of the song
-        cur.execute("""
-            UPDATE queue
-            SET position = ?
-            WHERE song_id = ?
-        """, (to_position, song_id))
-
-        con.commit()
-    except Exception as e:
-        con.rollback()
-        cur.close()
-        con.close()
+        status, message = move_in_queue(to_position, entry_id, from_position, queue_owner())
+    except sql.Error as e:
         return jsonify({"error": f"An error occurred: {e}"}), 500
 
+    if status == 'missing':
+        return jsonify({"error": message}), 404
+    return jsonify({"message": message}), 200
+
+
+def create_app(config=None):
+    """
+    Returns the app for a wsgi server, e.g. gunicorn -w 4 --threads 8 'music_database:create_app()'.
+    Importing the module and creating the app don't write to the database or read the music folder, so
+    the server starts right away; `python music_database.py init` sets up and fills the database once
+    beforehand and `python music_database.py watch` keeps it in sync with the folder from a single process.
+    Workers share the queues through the database (see QueueStore), a change made in one worker shows up
+    in the others once it has been written, within about QUEUE_FLUSH_INTERVAL seconds.
+    """
+    if config:
+        app.config.update(config)
+    con = get_db_connection()
+    cur = con.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'schema_version'")
+    current = get_schema_version(cur) if cur.fetchone() else 0
     cur.close()
     con.close()
-    return jsonify({"message": f"Moved song from position {from_position} to {to_position}"}), 200
+    if current < MIGRATIONS[-1][0]:
+        raise RuntimeError(f"{db_path} is at schema version {current}, run `python music_database.py init` first")
+    return app
+
+
+def init_library():
+    # one-shot setup: brings the schema up to date and syncs the library with the music folder
+    log.info("Setting up the database and adding songs")
+    migrate()
+    # every endpoint that runs per play or per queue change should be using an index
+    for name, plan in check_query_plans().items():
+        log.warning("'%s' scans a whole table: %s", name, plan)
+    # only new, changed or removed files are touched, use clear_table() + add_Dir() for a full re-import
+    rescan_library()
+
 
 def main(): # (N) simple function that is creating the database and adding the songs from the default path (Music directory contained in the repository)
     try:
-        print("Setting up the database and adding songs")
-        clear_table()
-        create_table()
-        add_new_user_columns()
-        add_Dir()
+        init_library()
 
         # (Ja) initialize flask test client
         with app.test_client() as client:
@@ -1028,6 +4113,7 @@ def main(): # (N) simple function that is creating the database and adding the s
         cur.execute("SELECT name FROM songs")
         song_names = [row[0] for row in cur.fetchall()]
         cur.close()
+        con.close()
         print(f"\nAdded {len(song_names)} songs to the database.")
         for song in song_names[:5]:  # (Jo) Adds songs to the queue
             add_to_queue(song)
@@ -1037,10 +4123,45 @@ def main(): # (N) simple function that is creating the database and adding the s
         if not song_names:
             print("No songs were found in the specified directory.")
         print("Current queue:", get_from_queue())
-        con.close()
 
     except Exception as e:
         print(f"An error occurred during execution: {e}")
         
-main()
-app.run(debug=True)
+# the ingest process pool re-imports this module in its workers on platforms that spawn them,
+# so the database setup and the server only run when the file is executed directly
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    parser = argparse.ArgumentParser(description="Music database backend. Without a command it sets up the "
+                                                 "database, runs the smoke test and starts the development server")
+    parser.add_argument("command", nargs="?", choices=["init", "watch", "serve", "check"],
+                        help="init: set up and fill the database and exit, watch: init and then keep the "
+                             "database in sync with the music folder, serve: development server without the smoke "
+                             "test, check: fail if a hot query isn't indexed in a newly migrated database")
+    command = parser.parse_args().command
+
+    if command == "check":
+        try:
+            check_schema()
+        except AssertionError as e:
+            sys.exit(f"Query plan check failed: {e}")
+        print("Every hot query uses an index.")
+    elif command in ("init", "watch"):
+        init_library()
+        if command == "watch":
+            watcher = LibraryWatcher()
+            watcher.start()
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                watcher.stop()
+    else:
+        # with the debug reloader the file runs twice, only the process that serves requests sets up
+        # the database and watches the library
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            init_library() if command == "serve" else main()
+            LibraryWatcher().start()
+        app.run(debug=True)
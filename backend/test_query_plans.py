@@ -0,0 +1,20 @@
+import music_database
+
+
+def migrated_database(tmp_path, monkeypatch):
+    monkeypatch.setattr(music_database, "db_path", str(tmp_path / "music_library.db"))
+    music_database.migrate()
+
+
+def test_hot_queries_use_indexes(tmp_path, monkeypatch):
+    migrated_database(tmp_path, monkeypatch)
+    assert music_database.check_query_plans() == {}
+
+
+def test_missing_index_is_reported(tmp_path, monkeypatch):
+    migrated_database(tmp_path, monkeypatch)
+    con = music_database.get_db_connection()
+    con.execute("DROP INDEX queue_owner")
+    con.commit()
+    con.close()
+    assert "queue of a device" in music_database.check_query_plans()
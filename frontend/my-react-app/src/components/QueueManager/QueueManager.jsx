@@ -140,7 +140,7 @@ function QueueManager({ children }) {
                     {availableSongs.map((song) => (
                         <div key={`library-${song.id}-${song.title}`} className="song-item">
                             <div className="song-info">
-                                <img src={song.cover_art ? `http://127.0.0.1:5000/api/cover_art/${song.cover_art.split('/').pop()}` : defaultImage} alt={song.title} className="song-cover" />
+                                <img src={song.cover_art ? `http://127.0.0.1:5000/api/cover_art/${song.cover_art.split('/').pop()}?size=64` : defaultImage} alt={song.title} className="song-cover" />
                                 <div className="song-details">
                                     <h3>{song.title}</h3>
                                     <p>{song.artist}</p>
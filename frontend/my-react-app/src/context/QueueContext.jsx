@@ -10,11 +10,35 @@ Error and exception conditions: Rapid changes in positions that can cause race c
 Side effects: N/A
 */
 
-import { createContext, useContext, useState, useCallback, useEffect } from 'react';
+import { createContext, useContext, useState, useCallback, useEffect, useRef } from 'react';
 import defaultImage from '../assets/default.png';
 
 const QueueContext = createContext();
 
+/*
+Apply one 'queue' event from /api/events to the queue we have. Events either carry the whole queue ('reset')
+or describe a single add, remove or move (or several adds at once with 'extend'), after which the positions are renumbered the same way the backend does.
+*/
+const applyQueueEvent = (queue, event) => {
+    let entries = [...queue];
+    if (event.op === 'reset') {
+        entries = event.queue;
+    } else if (event.op === 'add') {
+        entries.push(event.entry);
+    } else if (event.op === 'extend') {
+        entries.push(...event.entries);
+    } else if (event.op === 'remove') {
+        entries = entries.filter(song => song.id !== event.id);
+    } else if (event.op === 'move') {
+        const index = entries.findIndex(song => song.id === event.id);
+        if (index !== -1) {
+            const [moved] = entries.splice(index, 1);
+            entries.splice(event.to_position - 1, 0, moved);
+        }
+    }
+    return entries.map((song, index) => ({ ...song, position: index + 1 }));
+};
+
 /*
 In order to manage states between the QueueManager and the Player components so any interactions between
 the QueueManager and the queue and then the Player and the queue are reflected accurately between the two.
@@ -27,6 +51,7 @@ Player is intended to read the queue and position for its songs, whle the QueueM
 export function QueueProvider({ children }) {
     const [queue, setQueue] = useState([]);
     const [currentQueuePosition, setCurrentQueuePosition] = useState(null);
+    const songDetailsCache = useRef(new Map());
 
     /*
     Retrieves the current queue from the backend using 'http://127.0.0.1:5000/api/queue'. 
@@ -48,6 +73,47 @@ export function QueueProvider({ children }) {
         }
     };
 
+    /*
+    Keep the queue in sync through the backend's event stream instead of refetching it after every change.
+    The first event is a snapshot of the whole queue, every 'queue' event after that is a single change.
+    */
+    useEffect(() => {
+        const source = new EventSource('http://127.0.0.1:5000/api/events');
+        source.addEventListener('snapshot', (e) => setQueue(JSON.parse(e.data).queue));
+        source.addEventListener('queue', (e) => setQueue(prev => applyQueueEvent(prev, JSON.parse(e.data))));
+        return () => source.close();
+    }, []);
+
+    /*
+    Same as fetchQueue, start from the front once the queue has songs in it.
+    */
+    useEffect(() => {
+        if (currentQueuePosition === null && queue.length > 0) {
+            setCurrentQueuePosition(queue[0].position);
+        }
+    }, [queue, currentQueuePosition]);
+
+    /*
+    Look up every queued song we don't have details for yet in one '/api/songs' call, so the Player
+    doesn't need a request per song when it moves through the queue.
+    */
+    useEffect(() => {
+        const names = [...new Set(queue.map(song => song.title))].filter(name => !songDetailsCache.current.has(name));
+        if (names.length === 0) {
+            return;
+        }
+        fetch('http://127.0.0.1:5000/api/songs', {
+            method: 'POST', headers: {'Content-Type': 'application/json',}, body: JSON.stringify({ names: names })
+        })
+            .then(response => response.json())
+            .then(data => data.songs.forEach((song, index) => {
+                if (song) {
+                    songDetailsCache.current.set(names[index], formatSongData(song));
+                }
+            }))
+            .catch(err => console.error(err));
+    }, [queue]);
+
     /*
     Moved from Player for consistency with QueueManager. Allows the player to navigate the queue without needing to
     maintain the queue state. (Instead QueueManager will do the bulk of the work)
@@ -110,8 +176,6 @@ export function QueueProvider({ children }) {
             if (!response.ok) {
                 throw new Error('Failed to add song to queue');
             }
-    
-            await fetchQueue();
         } catch (err) {
             console.error(err);
         }
@@ -131,7 +195,7 @@ export function QueueProvider({ children }) {
     const formatSongData = (songDetails) => {
         const filename = songDetails.path.split('\\').pop();
         const audioUrl = `http://127.0.0.1:5000/api/audio/${filename}`;
-        const coverArtUrl = songDetails.cover_art ? `http://127.0.0.1:5000/api/cover_art/${songDetails.cover_art.split('/').pop()}`: defaultImage;
+        const coverArtUrl = songDetails.cover_art ? `http://127.0.0.1:5000/api/cover_art/${songDetails.cover_art.split('/').pop()}?size=256`: defaultImage;
 
         return {
             ...songDetails,
@@ -145,6 +209,9 @@ export function QueueProvider({ children }) {
     the song at the current index. We're provided with position and name from the queue, so we just use the name for this info. 
     */
     const fetchSongDetails = async (songName) => {
+        if (songDetailsCache.current.has(songName)) {
+            return songDetailsCache.current.get(songName);
+        }
         try {
             const response = await fetch(`http://127.0.0.1:5000/api/song/${encodeURIComponent(songName)}`);
             if (!response.ok) {
@@ -196,8 +263,6 @@ export function QueueProvider({ children }) {
             if (!response.ok) {
                 throw new Error('Failed to remove song from queue');
             }
-
-            await fetchQueue();
         } catch (err) {
             console.error(err);
         }